@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+"""
+Micro benchmarks for django-memoize.
+
+Run with ``python benchmark.py [name ...]``; without arguments every
+benchmark is run. Results are printed as the best time per call out of a
+few repetitions, using the local memory cache backend.
+"""
+import os
+import sys
+import timeit
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.test_settings'
+
+import django  # noqa: E402
+
+if hasattr(django, 'setup'):
+    django.setup()
+
+from memoize import (  # noqa: E402
+    InMemoryTracer, Memoizer, MemoizeStats, PickleSerializer, WriteBehind,
+    batch_scope
+)
+
+BENCHMARKS = []
+
+
+def benchmark(f):
+    BENCHMARKS.append(f)
+    return f
+
+
+def report(label, stmt, number=20000, repeat=5):
+    best = min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+    print('%-50s %10.2f us' % (label, best * 1e6))
+    return best
+
+
+@benchmark
+def hit_path():
+    """
+    Cost of a cache hit, with and without the precomputed key plan.
+    """
+    memoizer = Memoizer()
+
+    class Service(object):
+        def __repr__(self):
+            return 'Service()'
+
+        @memoizer.memoize(timeout=300)
+        def lookup(self, a, b=2, *args, **kwargs):
+            return a + b
+
+    service = Service()
+    service.lookup(1, b=3)
+
+    precomputed = report(
+        'hit, precomputed key plan', lambda: service.lookup(1, b=3)
+    )
+
+    # Rebuilding the key plan on every call is what the hit path used to do.
+    make_cache_key = memoizer._memoize_make_cache_key(
+        None, Service.lookup
+    )
+    uncached = Service.lookup.uncached
+
+    def introspect():
+        memoizer.get(make_cache_key(uncached, service, 1, b=3))
+
+    introspected = report('hit, introspecting on every call', introspect)
+    print('%-50s %10.2fx' % ('speedup', introspected / precomputed))
+
+
+@benchmark
+def batch():
+    """
+    Cost of 100 cache hits, one call at a time and with many().
+    """
+    memoizer = Memoizer()
+
+    @memoizer.memoize(timeout=300)
+    def lookup(a):
+        return a
+
+    ids = list(range(100))
+    lookup.many(ids)
+
+    one_by_one = report(
+        'hits, one call at a time', lambda: [lookup(i) for i in ids],
+        number=200
+    )
+    batched = report('hits, many()', lambda: lookup.many(ids), number=200)
+    print('%-50s %10.2fx' % ('speedup', one_by_one / batched))
+
+
+@benchmark
+def key_hashing():
+    """
+    Cost and length of cache keys, md5 of the repr vs CanonicalKeyHasher.
+    """
+    import hashlib
+
+    from django.utils.encoding import force_bytes
+
+    from memoize import CanonicalKeyHasher
+
+    fname = 'benchmark.lookup'
+    cases = [
+        ('small', (1, 'abc'), {'flag': True}),
+        ('large dict', (dict(('key%d' % i, i) for i in range(200)),), {}),
+        ('nested list', ([[i, str(i)] for i in range(200)],), {}),
+    ]
+    hashers = [
+        ('md5(repr)', lambda name, args, kwargs: hashlib.md5(
+            force_bytes((name, args, kwargs))).hexdigest()),
+        ('blake2b/16', CanonicalKeyHasher()),
+        ('blake2b/10', CanonicalKeyHasher(digest_size=10)),
+    ]
+
+    for case, args, kwargs in cases:
+        for label, hasher in hashers:
+            report('%s, %s' % (case, label),
+                   lambda: hasher(fname, args, kwargs), number=2000)
+    for label, hasher in hashers:
+        print('%-50s %10d chars' % (
+            'key length, %s' % label, len(hasher(fname, (), {}))
+        ))
+
+
+@benchmark
+def buffer_keys():
+    """
+    Cost of the key of an 8MB argument, repr vs hashing its buffer.
+    """
+    import hashlib
+
+    from django.utils.encoding import force_bytes
+
+    from memoize import key_fragment
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    fname = 'benchmark.lookup'
+    cases = [
+        ('bytes', b'x' * (8 << 20)),
+        ('bytearray', bytearray(8 << 20)),
+        ('memoryview', memoryview(bytearray(8 << 20))),
+    ]
+    if numpy is not None:
+        cases.append(('numpy array', numpy.zeros(1 << 20)))
+
+    for case, data in cases:
+        report('%s, md5(repr)' % case, lambda: hashlib.md5(
+            force_bytes((fname, (data,), {}))).hexdigest(), number=5)
+        report('%s, buffer hash' % case, lambda: hashlib.md5(
+            force_bytes((fname, (key_fragment(data),), {}))).hexdigest(),
+            number=5)
+
+
+@benchmark
+def instrumentation():
+    """
+    Cost of a cache hit without stats nor tracing, with stats, and traced.
+    """
+    results = []
+    for label, memoizer in (('hit, stats and tracing disabled', Memoizer()),
+                            ('hit, stats enabled',
+                             Memoizer(stats=MemoizeStats())),
+                            ('hit, 1% of calls traced',
+                             Memoizer(tracer=InMemoryTracer(),
+                                      trace_sample_rate=0.01))):
+        @memoizer.memoize(timeout=300)
+        def lookup(a):
+            return a
+
+        lookup(1)
+        results.append(report(label, lambda: lookup(1)))
+    print('%-50s %10.2fx' % ('stats overhead', results[1] / results[0]))
+    print('%-50s %10.2fx' % ('tracing overhead', results[2] / results[0]))
+
+
+@benchmark
+def compression():
+    """
+    Stored size and hit cost of a 1000 rows report, with and without
+    compression.
+    """
+    import pickle
+
+    rows = [{'id': i, 'name': 'user %d' % i, 'active': i % 2 == 0}
+            for i in range(1000)]
+    for label, memoizer in (('uncompressed', Memoizer()),
+                            ('compressed',
+                             Memoizer(cache_prefix='compressed',
+                                      compress_threshold=1024))):
+        @memoizer.memoize(timeout=300)
+        def report_rows():
+            return rows
+
+        report_rows()
+        stored = memoizer.get(
+            report_rows.make_cache_key(report_rows.uncached)
+        )
+        print('%-50s %10d B' % ('%s, stored size' % label,
+                                len(pickle.dumps(stored, -1))))
+        report('%s, hit' % label, report_rows, number=2000)
+
+
+@benchmark
+def serializers():
+    """
+    Round trip time and peak memory of 8MB values, pickled by the cache
+    backend vs PickleSerializer, with backends storing bytes as is.
+    """
+    import pickle
+    import tracemalloc
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    serializer = PickleSerializer()
+    cases = [('bytes', b'x' * (8 << 20))]
+    if numpy is not None:
+        cases.append(('numpy array', numpy.zeros(1 << 20)))
+
+    def backend(value):
+        return pickle.loads(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def serialized(value):
+        return serializer.loads(serializer.dumps(value))
+
+    for case, value in cases:
+        for label, round_trip in (('backend pickle', backend),
+                                  ('PickleSerializer', serialized)):
+            report('%s, %s' % (case, label), lambda: round_trip(value),
+                   number=20)
+            tracemalloc.start()
+            round_trip(value)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('%-50s %10.1f MB' % ('%s, %s, peak' % (case, label),
+                                       peak / float(1 << 20)))
+
+
+@benchmark
+def write_behind():
+    """
+    Cost of a miss with a backend taking 1ms per write, storing the value in
+    the caller and with write_behind.
+    """
+    import itertools
+    import time
+
+    results = []
+    for label, write_behind in (('miss, direct set', None),
+                                ('miss, write_behind', WriteBehind())):
+        memoizer = Memoizer(write_behind=write_behind)
+        cache_set, cache_set_many = memoizer.set, memoizer.set_many
+
+        def slow_set(*args, **kwargs):
+            time.sleep(0.001)
+            return cache_set(*args, **kwargs)
+
+        def slow_set_many(*args, **kwargs):
+            batches.append(len(args[0]))
+            time.sleep(0.001)
+            return cache_set_many(*args, **kwargs)
+
+        batches = []
+        memoizer.set, memoizer.set_many = slow_set, slow_set_many
+
+        @memoizer.memoize(timeout=300)
+        def lookup(a):
+            return a
+
+        counter = itertools.count()
+        results.append(report(label, lambda: lookup(next(counter)),
+                              number=200))
+        if write_behind is not None:
+            write_behind.flush()
+            print('%-50s %10.1f' % ('values per set_many',
+                                    sum(batches) / float(len(batches))))
+    print('%-50s %10.2fx' % ('speedup', results[0] / results[1]))
+
+
+@benchmark
+def batching():
+    """
+    Cost of hits on 10 different memoized functions with a backend taking 1ms
+    per request, called one after the other and in a batch_scope.
+    """
+    import time
+
+    memoizer = Memoizer()
+    cache_get, cache_get_many = memoizer.get, memoizer.get_many
+
+    def slow_get(*args, **kwargs):
+        time.sleep(0.001)
+        return cache_get(*args, **kwargs)
+
+    def slow_get_many(*args, **kwargs):
+        time.sleep(0.001)
+        return cache_get_many(*args, **kwargs)
+
+    memoizer.get, memoizer.get_many = slow_get, slow_get_many
+
+    def make_lookup(i):
+        def lookup(a):
+            return a + i
+        lookup.__name__ = lookup.__qualname__ = 'lookup%d' % i
+        return memoizer.memoize(timeout=300)(lookup)
+
+    functions = [make_lookup(i) for i in range(10)]
+    [lookup(1) for lookup in functions]
+
+    def batched():
+        with batch_scope():
+            results = [lookup(1) for lookup in functions]
+        return [result.get() for result in results]
+
+    assert batched() == [lookup(1) for lookup in functions]
+    serial = report('hits, one call at a time',
+                    lambda: [lookup(1) for lookup in functions], number=20)
+    batch = report('hits, batch_scope', batched, number=20)
+    print('%-50s %10.2fx' % ('speedup', serial / batch))
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for f in BENCHMARKS:
+        if not names or f.__name__ in names:
+            print('%s: %s' % (f.__name__, f.__doc__.strip()))
+            f()
+            print('')
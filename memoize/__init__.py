@@ -2,203 +2,3832 @@
 __version__ = '2.3.1'
 __versionfull__ = __version__
 
+import asyncio
+import atexit
+import bisect
+import contextlib
 import functools
 import hashlib
 import inspect
+import io
+import itertools
 import logging
+import math
+import os
+import pickle
+import random
+import struct
 import sys
+import threading
 import uuid
 import time
+import weakref
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent import futures
 
 from django.conf import settings
 from django.core.cache import cache as default_cache
 from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import EmptyResultSet, ImproperlyConfigured
+from django.db import close_old_connections
+from django.db.models import Model, QuerySet
+from django.dispatch import Signal
 from django.utils.encoding import force_bytes
 
+try:
+    import contextvars
+except ImportError:  # Python < 3.7
+    contextvars = None
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:  # Django < 3.0
+    sync_to_async = None
+
 logger = logging.getLogger(__name__)
 
 
-class DefaultCacheObject(object):
-    pass
+class DefaultCacheObject(object):
+    pass
+
+
+DEFAULT_CACHE_OBJECT = DefaultCacheObject()
+
+#: A memoized value stored with the time after which it is refreshed and the
+#: time it took to compute.
+_SoftValue = namedtuple('_SoftValue', ('expires', 'value', 'delta'))
+
+#: A memoized value stored as its compressed pickle, with the id of the preset
+#: dictionary it was compressed with, 0 for none.
+_CompressedValue = namedtuple('_CompressedValue', ('data', 'dict_id'))
+
+#: The manifest of a memoized value too large for one cache item, stored as
+#: ``count`` chunks of its pickle, of ``length`` bytes in total, under keys
+#: including ``token``.
+_ChunkedValue = namedtuple('_ChunkedValue',
+                           ('token', 'count', 'length', 'digest'))
+
+#: An exception raised by a memoized function, stored in place of its value
+#: and raised again on a hit.
+_CachedException = namedtuple('_CachedException', ('exception',))
+
+
+def _memoized_result(rv):
+    """
+    Returns a memoized value, or raises the exception stored in its place.
+    """
+    if isinstance(rv, _CachedException):
+        #: the same exception may be raised again and again from the request
+        #: scope or the local cache, its traceback would keep growing
+        raise rv.exception.with_traceback(None)
+    return rv
+
+
+def _get_argspec(f):
+    if sys.version_info[:2] >= (3, 0):
+        # inspect has deprecated getargspec since version 3.0
+        argspec = inspect.getfullargspec(f)
+    else:
+        try:
+            argspec = inspect.getargspec(f)
+        except ValueError:
+            # this can happen in python 3.5 when
+            # function has keyword-only arguments or annotations
+            argspec = inspect.getfullargspec(f)
+    return argspec
+
+
+#: Functions returning the key fragment of the instances of a type, set with
+#: ``register_cache_key``.
+_cache_key_functions = {}
+
+#: The key fragment function and type name of each type met so far, or None.
+_cache_key_resolved = {}
+
+
+def register_cache_key(cls, func):
+    """
+    Makes ``func(obj)`` the key fragment of the instances of ``cls`` and of
+    its subclasses, as if ``cls`` had a ``__cache_key__`` method. Meant for
+    types whose code cannot be changed.
+    """
+    _cache_key_functions[cls] = func
+    _cache_key_resolved.clear()
+
+
+#: Same as ``_cache_key_functions`` for types of optional libraries, by module
+#: and name, so that they need not be imported.
+_cache_key_functions_by_name = {}
+
+#: Buffers larger than this many bytes are keyed on their hash.
+_BUFFER_HASH_THRESHOLD = 1024
+
+
+def _resolve_cache_key(cls):
+    for base in inspect.getmro(cls):
+        func = base.__dict__.get('__cache_key__')
+        if func is None:
+            func = _cache_key_functions.get(base)
+        if func is None:
+            func = _cache_key_functions_by_name.get(
+                (base.__module__, base.__name__)
+            )
+        if func is not None:
+            name = '%s.%s' % (cls.__module__,
+                              getattr(cls, '__qualname__', cls.__name__))
+            return func, name
+    return None
+
+
+def key_fragment(obj):
+    """
+    Returns what stands for ``obj`` in cache keys: the result of its
+    ``__cache_key__`` method or of the function registered for its type, with
+    the name of its type, or ``obj`` itself.
+    """
+    cls = type(obj)
+    try:
+        resolved = _cache_key_resolved[cls]
+    except KeyError:
+        resolved = _cache_key_resolved[cls] = _resolve_cache_key(cls)
+    if resolved is None:
+        return obj
+    fragment = resolved[0](obj)
+    if fragment is obj:
+        return obj
+    return (resolved[1], fragment)
+
+
+def _model_cache_key(obj):
+    if obj.pk is None:
+        #: unsaved instances have nothing better to tell them apart
+        return repr(obj)
+    #: the same primary key may be another row in another database
+    return (obj._meta.app_label, obj._meta.model_name, obj._state.db, obj.pk)
+
+
+def _queryset_cache_key(queryset):
+    try:
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        sql, params = None, ()
+    return (
+        queryset.model._meta.app_label, queryset.model._meta.model_name,
+        queryset.db, sql, tuple(params),
+        #: the SQL does not tell these apart
+        queryset._iterable_class.__name__,
+        tuple(str(lookup) for lookup in queryset._prefetch_related_lookups),
+    )
+
+
+def _buffer_digest(view):
+    """
+    Returns the hash of the contents of the memoryview ``view``, without
+    copying them when they are contiguous.
+    """
+    if not view.c_contiguous:
+        view = memoryview(view.tobytes())
+    return hashlib.blake2b(view, digest_size=16).hexdigest()
+
+
+def _bytes_cache_key(obj):
+    if len(obj) <= _BUFFER_HASH_THRESHOLD:
+        return obj
+    return (len(obj), _buffer_digest(memoryview(obj)))
+
+
+def _memoryview_cache_key(view):
+    return (view.format, view.shape, _buffer_digest(view))
+
+
+def _array_cache_key(array):
+    if array.dtype.hasobject:
+        #: the buffer holds pointers to the objects
+        return (array.dtype.str, array.shape, repr(array.tolist()))
+    dtype = array.dtype.str
+    if array.dtype.kind in 'Mm':
+        #: datetime64 and timedelta64 do not export a buffer; their unit is
+        #: kept in ``dtype``
+        array = array.view('i8')
+    if not array.flags.c_contiguous:
+        array = array.copy(order='C')
+    try:
+        view = memoryview(array)
+    except (TypeError, ValueError):
+        view = memoryview(array.tobytes())
+    return (dtype, array.shape, _buffer_digest(view.cast('B')))
+
+
+register_cache_key(Model, _model_cache_key)
+register_cache_key(QuerySet, _queryset_cache_key)
+register_cache_key(bytes, _bytes_cache_key)
+register_cache_key(bytearray, _bytes_cache_key)
+register_cache_key(memoryview, _memoryview_cache_key)
+_cache_key_functions_by_name[('numpy', 'ndarray')] = _array_cache_key
+
+
+def _instance_token(obj):
+    """
+    Returns the string standing for the instance ``obj`` in the namespace of
+    its memoized methods.
+    """
+    cls = type(obj)
+    try:
+        resolved = _cache_key_resolved[cls]
+    except KeyError:
+        resolved = _cache_key_resolved[cls] = _resolve_cache_key(cls)
+    if resolved is None:
+        return repr(obj)
+    fragment = resolved[0](obj)
+    return fragment if isinstance(fragment, str) else repr(fragment)
+
+
+def function_namespace(f, args=None):
+    """
+    Attempts to returns unique namespace for function
+    """
+    m_args = _get_argspec(f).args
+    instance_token = None
+
+    instance_self = getattr(f, '__self__', None)
+
+    if instance_self and not inspect.isclass(instance_self):
+        instance_token = _instance_token(f.__self__)
+    elif m_args and m_args[0] == 'self' and args:
+        instance_token = _instance_token(args[0])
+
+    module = f.__module__ or __name__
+
+    if hasattr(f, '__qualname__'):
+        name = f.__qualname__
+    else:
+        klass = getattr(f, '__self__', None)
+
+        if klass and not inspect.isclass(klass):
+            klass = klass.__class__
+
+        if not klass:
+            klass = getattr(f, 'im_class', None)
+
+        if not klass:
+            if m_args and args:
+                if m_args[0] == 'self':
+                    klass = args[0].__class__
+                elif m_args[0] == 'cls':
+                    klass = args[0]
+
+        if klass:
+            name = klass.__name__ + '.' + f.__name__
+        else:
+            name = f.__name__
+
+    ns = '.'.join((module, name))
+
+    if instance_token:
+        ins = '.'.join((module, name, instance_token))
+    else:
+        ins = None
+
+    return ns, ins
+
+
+class _KeyPlan(object):
+    """
+    Per-function information needed to build cache keys, computed once when
+    the function is memoized instead of on every call.
+    """
+
+    def __init__(self, f, ignore=None, key_args=None):
+        argspec = _get_argspec(f)
+
+        self.f = f
+        self.args = tuple(argspec.args)
+        self.args_len = len(self.args)
+        self.defaults = tuple(argspec.defaults or ())
+        self.varargs = argspec.varargs
+        self.first_arg = self.args[0] if self.args else None
+        self.has_self = self.first_arg in ('self', 'cls')
+
+        #: arguments left out of the cache key
+        varkw = getattr(argspec, 'varkw', getattr(argspec, 'keywords', None))
+        names = set(self.args) | set(getattr(argspec, 'kwonlyargs', ()))
+        names.update(name for name in (self.varargs, varkw) if name)
+
+        if ignore is not None and key_args is not None:
+            raise ValueError("ignore and key_args are mutually exclusive")
+        if key_args is not None:
+            ignore = names.difference(key_args)
+            if self.has_self:
+                #: the instance is kept unless explicitly ignored
+                ignore.discard(self.first_arg)
+            unknown = set(key_args) - names
+        else:
+            ignore = set(ignore or ())
+            unknown = ignore - names
+        if unknown:
+            raise ValueError(
+                "%s has no argument named %s"
+                % (f.__name__, ', '.join(sorted(unknown)))
+            )
+
+        self.skip = frozenset(
+            i for i, name in enumerate(self.args) if name in ignore
+        )
+        self.skip_names = frozenset(ignore)
+        #: the instance is left out of the cache key, so its values are
+        #: shared by all instances and versioned per function only
+        self.skip_instance = self.has_self and 0 in self.skip
+        self.skip_varargs = self.varargs in ignore
+        self.skip_varkw = varkw in ignore
+
+        instance_self = getattr(f, '__self__', None)
+        if instance_self and not inspect.isclass(instance_self):
+            self.instance_self = instance_self
+        else:
+            self.instance_self = None
+
+        if hasattr(f, '__qualname__'):
+            module = f.__module__ or __name__
+            self.fname = '.'.join((module, f.__qualname__))
+        else:
+            #: the function name may depend on the call arguments
+            self.fname = None
+
+        #: set by the owning ``Memoizer``
+        self.version_key = None
+
+    def namespace(self, args=None):
+        """
+        Same as ``function_namespace(self.f, args)`` without inspecting the
+        function again.
+        """
+        if self.fname is None:
+            return function_namespace(self.f, args=args)
+
+        if self.skip_instance:
+            return self.fname, None
+        if self.instance_self is not None:
+            instance_token = _instance_token(self.instance_self)
+        elif self.first_arg == 'self' and args:
+            instance_token = _instance_token(args[0])
+        else:
+            return self.fname, None
+
+        return self.fname, '.'.join((self.fname, instance_token))
+
+    def bind(self, args, kwargs):
+        """
+        Same as ``Memoizer._memoize_kwargs_to_args``. ``kwargs`` is consumed.
+        """
+        new_args = []
+        arg_num = 0
+        args_len = self.args_len
+        defaults_len = len(self.defaults)
+        names = self.args
+
+        for i in range(args_len):
+            if i == 0 and self.has_self:
+                #: use the repr of the class instance
+                #: this supports instance methods for
+                #: the memoized functions, giving more
+                #: flexibility to developers
+                arg_num += 1
+                if self.skip_instance:
+                    continue
+                arg = _instance_token(args[0])
+            elif names[i] in kwargs:
+                arg = kwargs.pop(names[i])
+            elif arg_num < len(args):
+                arg = args[arg_num]
+                arg_num += 1
+            elif args_len - i <= defaults_len:
+                arg = self.defaults[i - args_len]
+                arg_num += 1
+            else:
+                arg = None
+                arg_num += 1
+
+            if i in self.skip:
+                continue
+
+            #: objects can stand for themselves in the cache key with
+            #: something cheaper and more stable than their repr, see
+            #: ``key_fragment``
+            new_args.append(key_fragment(arg))
+
+        # If there are any missing varargs then
+        # just append them since consistency of the key trumps order.
+        if self.varargs and args_len < len(args) and not self.skip_varargs:
+            new_args.extend(key_fragment(arg) for arg in args[args_len:])
+
+        if self.skip_varkw:
+            kwargs.clear()
+        elif self.skip_names:
+            for name in self.skip_names.intersection(kwargs):
+                del kwargs[name]
+
+        for name, value in kwargs.items():
+            kwargs[name] = key_fragment(value)
+
+        return tuple(new_args), kwargs
+
+
+def _encode_int(hasher, obj, write):
+    write(b'i%d;' % obj)
+
+
+def _encode_float(hasher, obj, write):
+    write(b'f' + repr(obj).encode('ascii') + b';')
+
+
+def _encode_str(hasher, obj, write):
+    data = obj.encode('utf-8', 'surrogatepass')
+    write(b's%d:' % len(data))
+    write(data)
+
+
+def _encode_bytes(hasher, obj, write):
+    if len(obj) > _BUFFER_HASH_THRESHOLD:
+        #: not copied into the encoding
+        write(b'B%d:' % len(obj))
+        write(_buffer_digest(memoryview(obj)).encode('ascii'))
+        return
+    write(b'b%d:' % len(obj))
+    write(obj)
+
+
+#: Types whose pickle tells their values apart, and tells them apart from
+#: each other.
+_PLAIN_TYPES = frozenset((type(None), bool, int, float, str))
+_SEQUENCE_TYPES = frozenset((list, tuple))
+_PLAIN_OR_SEQUENCE_TYPES = _PLAIN_TYPES | _SEQUENCE_TYPES
+#: Fixed so that keys do not change with the default protocol.
+_PLAIN_PROTOCOL = 4
+#: Smaller containers are cheaper to encode item by item.
+_PLAIN_MIN_ITEMS = 8
+
+
+def _is_plain(items):
+    """
+    Returns whether ``items`` are all of plain types, or lists and tuples of
+    items of plain types, in which case their pickle is a canonical
+    encoding.
+    """
+    types = set(map(type, items))
+    if types <= _PLAIN_TYPES:
+        return True
+    if types <= _SEQUENCE_TYPES:
+        return _PLAIN_TYPES.issuperset(
+            map(type, itertools.chain.from_iterable(items))
+        )
+    if types <= _PLAIN_OR_SEQUENCE_TYPES:
+        return _PLAIN_TYPES.issuperset(map(type, itertools.chain.from_iterable(
+            item for item in items if type(item) in _SEQUENCE_TYPES
+        )))
+    return False
+
+
+#: Per thread, as picklers are not thread-safe.
+_plain_picklers = threading.local()
+
+
+def _dump_plain(obj):
+    """
+    Returns the pickle of ``obj``, made of items of plain types, in one pass
+    of the C pickler rather than item by item.
+    """
+    try:
+        buffer, pickler = _plain_picklers.pickler
+    except AttributeError:
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, _PLAIN_PROTOCOL)
+        #: without memo, equal values pickle the same whether or not they
+        #: share objects
+        pickler.fast = True
+        _plain_picklers.pickler = buffer, pickler
+    buffer.seek(0)
+    buffer.truncate()
+    pickler.dump(obj)
+    return buffer.getvalue()
+
+
+def _encode_plain(tag, obj, write):
+    data = _dump_plain(obj)
+    write(b'p%s%d:' % (tag, len(data)))
+    write(data)
+
+
+def _encode_sequence(tag):
+    def encode(hasher, obj, write):
+        if len(obj) >= _PLAIN_MIN_ITEMS and _is_plain(obj):
+            _encode_plain(tag, obj, write)
+            return
+        write(b'%s%d(' % (tag, len(obj)))
+        encoders = hasher.encoders
+        for item in obj:
+            encoder = encoders.get(type(item))
+            if encoder is not None:
+                encoder(hasher, item, write)
+            else:
+                hasher.encode_other(item, write)
+        write(b')')
+    return encode
+
+
+def _encode_set(tag):
+    def encode(hasher, obj, write):
+        #: the order of the items is not part of the value
+        items = sorted(hasher.encoded(item) for item in obj)
+        write(b'%s%d(' % (tag, len(items)))
+        for item in items:
+            write(item)
+        write(b')')
+    return encode
+
+
+def _encode_dict(hasher, obj, write):
+    #: nor is the order of the keys
+    if len(obj) >= _PLAIN_MIN_ITEMS and set(map(type, obj)) <= {str} and \
+            _is_plain(obj.values()):
+        keys = sorted(obj)
+        _encode_plain(b'd', (keys, list(map(obj.__getitem__, keys))), write)
+        return
+    items = []
+    for key, value in obj.items():
+        if type(key) is str:
+            key = key.encode('utf-8', 'surrogatepass')
+            key = b's%d:%s' % (len(key), key)
+        else:
+            key = hasher.encoded(key)
+        items.append((key, value))
+    items.sort(key=lambda item: item[0])
+    write(b'd%d(' % len(items))
+    encoders = hasher.encoders
+    for key, value in items:
+        write(key)
+        encoder = encoders.get(type(value))
+        if encoder is not None:
+            encoder(hasher, value, write)
+        else:
+            hasher.encode_other(value, write)
+    write(b')')
+
+
+class CanonicalKeyHasher(object):
+    """
+    Builds the hashed part of cache keys from a canonical encoding of the
+    function name and arguments, fed as it is produced to ``blake2b``.
+
+    Every value is encoded with a tag of its type, so that ``1``, ``1.0``,
+    ``'1'`` and ``b'1'`` give different keys. Keyword arguments, dict keys and
+    set items are sorted, so their order does not matter. Arguments holding
+    only ``None``, booleans, integers, floats and strings, possibly in lists
+    and tuples, are pickled at once, as are large lists, tuples and dicts of
+    them; other containers are encoded recursively. Values of other types
+    are encoded with the name of their type and their ``repr``.
+
+    ``digest_size`` is the size of the hash in bytes; keys contain twice as
+    many hexadecimal characters.
+    """
+
+    encoders = {
+        type(None): lambda hasher, obj, write: write(b'N'),
+        bool: lambda hasher, obj, write: write(b'T' if obj else b'F'),
+        int: _encode_int,
+        float: _encode_float,
+        str: _encode_str,
+        bytes: _encode_bytes,
+        bytearray: _encode_bytes,
+        tuple: _encode_sequence(b't'),
+        list: _encode_sequence(b'l'),
+        set: _encode_set(b'S'),
+        frozenset: _encode_set(b'z'),
+        dict: _encode_dict,
+    }
+
+    def __init__(self, digest_size=16):
+        self.digest_size = digest_size
+
+    def __call__(self, fname, args, kwargs):
+        args = tuple(args)
+        if type(fname) is str and _is_plain(args + tuple(kwargs.values())) \
+                and all(type(name) is str for name in kwargs):
+            #: the whole call in one pass
+            hasher = hashlib.blake2b(b'P', digest_size=self.digest_size)
+            hasher.update(_dump_plain((fname, args, sorted(kwargs.items()))))
+            return hasher.hexdigest()
+
+        hasher = hashlib.blake2b(digest_size=self.digest_size)
+        self.encode(fname, hasher.update)
+        self.encode(args, hasher.update)
+        self.encode(kwargs, hasher.update)
+        return hasher.hexdigest()
+
+    def encode(self, obj, write):
+        """
+        Passes the encoding of ``obj`` to ``write``, possibly in several
+        parts.
+        """
+        encoder = self.encoders.get(type(obj))
+        if encoder is not None:
+            encoder(self, obj, write)
+        else:
+            self.encode_other(obj, write)
+
+    def encode_other(self, obj, write):
+        """
+        Encodes a value of a type without encoder.
+        """
+        fragment = key_fragment(obj)
+        if fragment is not obj:
+            self.encode(fragment, write)
+            return
+
+        cls = type(obj)
+        name = ('%s.%s' % (cls.__module__, cls.__qualname__)).encode('utf-8')
+        data = repr(obj).encode('utf-8', 'surrogatepass')
+        write(b'r%d:%s%d:' % (len(name), name, len(data)))
+        write(data)
+
+    def encoded(self, obj):
+        """
+        Returns the encoding of ``obj`` as bytes.
+        """
+        parts = []
+        self.encode(obj, parts.append)
+        return b''.join(parts)
+
+
+class PickleSerializer(object):
+    """
+    Serializes memoized values to bytes. Values are pickled with
+    ``protocol``, by default 5 where available, in which case the buffers of
+    large objects such as NumPy arrays are kept out of the pickle stream and
+    appended to it, and read back without being copied. Other pickles are
+    stored as is, as they start with the ``PROTO`` opcode, and only those of
+    protocols 0 and 1 get a tag.
+
+    Objects rebuilt from out-of-band buffers, e.g. NumPy arrays, are
+    read-only.
+    """
+
+    _frame = struct.Struct('<I')
+    _length = struct.Struct('<Q')
+
+    def __init__(self, protocol=None):
+        if protocol is None:
+            protocol = min(5, pickle.HIGHEST_PROTOCOL)
+        self.protocol = protocol
+
+    def dumps(self, value):
+        if self.protocol < 2:
+            return b'P' + pickle.dumps(value, self.protocol)
+        if self.protocol < 5:
+            return pickle.dumps(value, self.protocol)
+
+        buffers = []
+        data = pickle.dumps(value, self.protocol,
+                            buffer_callback=buffers.append)
+        if not buffers:
+            #: not copied behind a tag
+            return data
+
+        views = [buffer.raw() for buffer in buffers]
+        header = [b'O', self._frame.pack(len(views)),
+                  self._length.pack(len(data))]
+        header.extend(self._length.pack(view.nbytes) for view in views)
+        return b''.join(header + [data] + views)
+
+    def loads(self, data):
+        tag = data[:1]
+        if tag == pickle.PROTO:
+            return pickle.loads(data)
+        view = memoryview(data)
+        if tag == b'P':
+            return pickle.loads(view[1:])
+        if tag != b'O':
+            raise ValueError('Unknown serialized value format %r' % tag)
+
+        count = self._frame.unpack_from(data, 1)[0]
+        offset = 1 + self._frame.size
+        lengths = [
+            self._length.unpack_from(data, offset + i * self._length.size)[0]
+            for i in range(count + 1)
+        ]
+        offset += len(lengths) * self._length.size
+        buffers = []
+        for length in lengths:
+            buffers.append(view[offset:offset + length])
+            offset += length
+        if offset != len(view):
+            raise ValueError('Truncated serialized value')
+        return pickle.loads(buffers[0], buffers=buffers[1:])
+
+
+class LocalVersionCache(object):
+    """
+    In-process copy of the version hashes of memoized functions.
+
+    Versions are kept for at most ``timeout`` seconds, so a version changed
+    by another process is picked up after that delay. Changes made by this
+    process are visible immediately.
+
+    ``hits`` counts the version fetches that were avoided and ``misses`` the
+    ones that went to the cache backend.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._versions = {}
+
+    def get_many(self, keys):
+        now = time.time()
+        values = []
+        for key in keys:
+            entry = self._versions.get(key)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                values.append(entry[0])
+            else:
+                self.misses += 1
+                values.append(None)
+        return values
+
+    def set_many(self, mapping):
+        expires = time.time() + self.timeout
+        for key, value in mapping.items():
+            if value is None:
+                self._versions.pop(key, None)
+            else:
+                self._versions[key] = (value, expires)
+
+    def delete(self, key):
+        self._versions.pop(key, None)
+
+    def clear(self):
+        self._versions.clear()
+
+
+class LocalCache(object):
+    """
+    Bounded in-process copy of memoized values, consulted before the cache
+    backend.
+
+    At most ``max_entries`` values, and if set ``max_bytes`` bytes of pickled
+    values, are kept; the least recently used ones are dropped first. Each
+    value is kept for at most the timeout given to ``set``.
+
+    Values are returned as stored, not as copies, so they should not be
+    mutated by the caller.
+
+    ``hits`` counts the lookups served in process and ``misses`` the ones that
+    went to the cache backend.
+    """
+
+    def __init__(self, timeout, max_entries=1000, max_bytes=None):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[1] <= now:
+                self._pop(key)
+                self.misses += 1
+                return default
+            self._values.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, timeout, tags=()):
+        """
+        Stores ``value`` for ``timeout`` seconds. ``tags`` are names that can
+        later be passed to ``delete_tag`` to drop the value.
+        """
+        if self.max_bytes is not None:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            if size > self.max_bytes:
+                self.delete(key)
+                return
+        else:
+            size = 0
+
+        expires = time.time() + timeout
+        with self._lock:
+            self._pop(key)
+            self._values[key] = (value, expires, size, tuple(tags))
+            self.size += size
+
+            while (len(self._values) > self.max_entries or
+                   (self.max_bytes is not None and
+                    self.size > self.max_bytes)):
+                self._pop(next(iter(self._values)))
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def delete_tag(self, tag):
+        with self._lock:
+            keys = [
+                key for key, entry in self._values.items() if tag in entry[3]
+            ]
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        entry = self._values.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+class SingleFlight(object):
+    """
+    Registry of the memoized values being computed in this process, so that
+    concurrent misses on the same key run the function only once.
+
+    Threads that find a computation in flight wait for at most ``timeout``
+    seconds for its result, then compute the value themselves.
+
+    ``coalesced`` counts the calls that were served the result of another
+    thread, ``timeouts`` the waits that gave up and ``failures`` the waits
+    whose computation raised, after which the waiting threads compute the
+    value themselves as well.
+    """
+
+    _missing = object()
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.coalesced = 0
+        self.timeouts = 0
+        self.failures = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, compute):
+        """
+        Returns ``compute()``, or the result of the call of ``compute`` for
+        ``key`` already running in another thread.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = [threading.Event(),
+                                               self._missing]
+                leader = True
+            else:
+                leader = False
+
+        if leader:
+            try:
+                flight[1] = compute()
+                return flight[1]
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight[0].set()
+
+        if not flight[0].wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+        elif flight[1] is self._missing:
+            with self._lock:
+                self.failures += 1
+        else:
+            with self._lock:
+                self.coalesced += 1
+            return flight[1]
+        return compute()
+
+
+class AsyncSingleFlight(object):
+    """
+    Registry of the memoized values being computed by the tasks of an event
+    loop, so that concurrent misses on the same key run the coroutine
+    function only once.
+
+    The computation runs in its own task, so it is not cancelled with the
+    task that started it. ``coalesced`` counts the calls that were served the
+    result of another task.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights = weakref.WeakKeyDictionary()
+
+    async def run(self, key, compute):
+        """
+        Returns the result of ``compute()``, or of the computation of ``key``
+        already running in the current event loop.
+        """
+        task, started = self._start(key, compute)
+        if not started:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def submit(self, key, compute):
+        """
+        Runs ``compute()`` in the background unless a computation of ``key``
+        is already running. Returns whether it was started.
+        """
+        return self._start(key, compute)[1]
+
+    def _start(self, key, compute):
+        loop = asyncio.get_event_loop()
+        flights = self._flights.setdefault(loop, {})
+        task = flights.get(key)
+        if task is not None:
+            return task, False
+
+        task = flights[key] = asyncio.ensure_future(compute())
+        task.add_done_callback(lambda task: flights.pop(key, None))
+        return task, True
+
+
+class BackgroundRefresher(object):
+    """
+    Bounded pool of threads refreshing the memoized values served stale.
+
+    At most ``max_pending`` refreshes are queued or running, and only one per
+    cache key; other requests are dropped.
+
+    ``scheduled`` counts the refreshes queued and ``skipped`` the ones
+    dropped.
+    """
+
+    def __init__(self, max_workers=2, max_pending=100):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.scheduled = 0
+        self.skipped = 0
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, refresh):
+        """
+        Queues ``refresh()`` unless a refresh of ``key`` is already pending.
+        Returns whether it was queued.
+        """
+        with self._lock:
+            if key in self._pending or len(self._pending) >= self.max_pending:
+                self.skipped += 1
+                return False
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers
+                )
+            self._pending[key] = None
+            self.scheduled += 1
+
+        future = self._executor.submit(self._run, key, refresh)
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] = future
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Waits for the pending refreshes to finish.
+        """
+        with self._lock:
+            pending = [f for f in self._pending.values() if f is not None]
+        futures.wait(pending, timeout=timeout)
+
+    def _run(self, key, refresh):
+        try:
+            refresh()
+        except Exception:
+            logger.exception("Exception while refreshing a memoized value.")
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            close_old_connections()
+
+
+#: Sent by ``SignalExporter`` with the ``stats`` snapshot of a memoizer.
+stats_exported = Signal()
+
+#: Upper bounds of the histogram buckets, in seconds for timings and in bytes
+#: for sizes.
+TIME_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0,
+                float('inf'))
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576,
+                float('inf'))
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.9, 1.0, float('inf'))
+
+
+class _Histogram(object):
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class MemoizeStats(object):
+    """
+    Counters and histograms of the calls of memoized functions, by function
+    namespace.
+
+    Counters are ``hits``, ``local_hits`` and ``scope_hits`` (hits served by
+    the local cache and by the request scope), ``misses`` and ``errors``
+    (cache backend exceptions). Histograms are
+    ``key_time``, ``get_time``, ``set_time``, ``compute_time``,
+    ``compress_time`` and ``decompress_time``, in seconds, ``size``, the
+    pickled size of the stored values in bytes, and ``compression_ratio``,
+    the compressed size of the values over the threshold over their pickled
+    size.
+
+    ``export()`` passes a snapshot to each of ``exporters``, callables such
+    as ``LoggingExporter``, ``SignalExporter`` or ``PrometheusExporter``.
+    """
+
+    counters = ('hits', 'local_hits', 'scope_hits', 'misses', 'errors')
+    histograms = {
+        'key_time': TIME_BUCKETS,
+        'get_time': TIME_BUCKETS,
+        'set_time': TIME_BUCKETS,
+        'compute_time': TIME_BUCKETS,
+        'compress_time': TIME_BUCKETS,
+        'decompress_time': TIME_BUCKETS,
+        'size': SIZE_BUCKETS,
+        'compression_ratio': RATIO_BUCKETS,
+    }
+
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def _function(self, name):
+        try:
+            return self._functions[name]
+        except KeyError:
+            return self._functions.setdefault(name, (
+                dict.fromkeys(self.counters, 0),
+                dict((metric, _Histogram(bounds))
+                     for metric, bounds in self.histograms.items())
+            ))
+
+    def incr(self, name, counter, n=1):
+        """
+        Adds ``n`` to ``counter`` of the function ``name``.
+        """
+        with self._lock:
+            self._function(name)[0][counter] += n
+
+    def observe(self, name, metric, value):
+        """
+        Records ``value`` in the histogram ``metric`` of the function
+        ``name``.
+        """
+        with self._lock:
+            self._function(name)[1][metric].observe(value)
+
+    def snapshot(self):
+        """
+        Returns the counters and histograms of each function, by namespace.
+        Histograms are dicts with the ``count`` and ``sum`` of the values and
+        the cumulative count of each bucket, by upper bound.
+        """
+        with self._lock:
+            snapshot = {}
+            for name, (counters, histograms) in self._functions.items():
+                data = snapshot[name] = dict(counters)
+                for metric, histogram in histograms.items():
+                    data[metric] = histogram.snapshot()
+            return snapshot
+
+    def export(self):
+        """
+        Passes a snapshot to each exporter.
+        """
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            try:
+                exporter(snapshot)
+            except Exception:
+                logger.exception("Exception while exporting memoize stats.")
+
+    def reset(self):
+        with self._lock:
+            self._functions.clear()
+
+
+class LoggingExporter(object):
+    """
+    Logs the counters and mean timings of each function.
+    """
+
+    def __init__(self, logger=logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, snapshot):
+        for name, data in sorted(snapshot.items()):
+            calls = data['hits'] + data['misses']
+            timings = ' '.join(
+                '%s=%.6f' % (metric, histogram['sum'] / histogram['count'])
+                for metric, histogram in (
+                    (metric, data[metric]) for metric in
+                    ('key_time', 'get_time', 'set_time', 'compute_time',
+                     'compress_time', 'decompress_time', 'compression_ratio')
+                )
+                if histogram['count']
+            )
+            self.logger.log(
+                self.level,
+                "memoize %s: hits=%d misses=%d errors=%d hit_ratio=%.3f %s",
+                name, data['hits'], data['misses'], data['errors'],
+                data['hits'] / calls if calls else 0.0, timings
+            )
+
+
+class SignalExporter(object):
+    """
+    Sends ``signal``, ``stats_exported`` by default, with the snapshot as
+    ``stats``.
+    """
+
+    def __init__(self, signal=stats_exported, sender=None):
+        self.signal = signal
+        self.sender = sender
+
+    def __call__(self, snapshot):
+        self.signal.send(sender=self.sender or self.__class__,
+                         stats=snapshot)
+
+
+def _prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _prometheus_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def prometheus_text(snapshot, prefix='memoize'):
+    """
+    Returns a snapshot in the Prometheus text exposition format.
+    """
+    lines = []
+    for counter in MemoizeStats.counters:
+        metric = '%s_%s_total' % (prefix, counter)
+        lines.append('# TYPE %s counter' % metric)
+        for name, data in sorted(snapshot.items()):
+            lines.append('%s{function="%s"} %d'
+                         % (metric, _prometheus_label(name), data[counter]))
+    for histogram in sorted(MemoizeStats.histograms):
+        if histogram == 'size':
+            metric = '%s_value_bytes' % prefix
+        elif histogram.endswith('_time'):
+            metric = '%s_%s_seconds' % (prefix, histogram[:-len('_time')])
+        else:
+            metric = '%s_%s' % (prefix, histogram)
+        lines.append('# TYPE %s histogram' % metric)
+        for name, data in sorted(snapshot.items()):
+            label = _prometheus_label(name)
+            for bound, count in data[histogram]['buckets']:
+                lines.append('%s_bucket{function="%s",le="%s"} %d'
+                             % (metric, label, _prometheus_bound(bound),
+                                count))
+            lines.append('%s_sum{function="%s"} %r'
+                         % (metric, label, data[histogram]['sum']))
+            lines.append('%s_count{function="%s"} %d'
+                         % (metric, label, data[histogram]['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusExporter(object):
+    """
+    Writes the snapshot in the Prometheus text format to ``path``, e.g. for
+    the textfile collector of the node exporter. The file is replaced
+    atomically. The last text written is kept as ``text``.
+    """
+
+    def __init__(self, path=None, prefix='memoize'):
+        self.path = path
+        self.prefix = prefix
+        self.text = None
+
+    def __call__(self, snapshot):
+        self.text = prometheus_text(snapshot, prefix=self.prefix)
+        if self.path:
+            tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(self.text)
+            os.replace(tmp_path, self.path)
+
+
+class _ContextVar(object):
+    """
+    ``contextvars.ContextVar`` defaulting to None, or a thread local on
+    Python < 3.7.
+    """
+
+    def __init__(self, name):
+        if contextvars is not None:
+            self._var = contextvars.ContextVar(name, default=None)
+        else:
+            self._var = None
+            self._local = threading.local()
+
+    def get(self):
+        if self._var is not None:
+            return self._var.get()
+        return getattr(self._local, 'value', None)
+
+    def set(self, value):
+        if self._var is not None:
+            return self._var.set(value)
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        if self._var is not None:
+            self._var.reset(token)
+        else:
+            self._local.value = token
+
+
+class _ScopeCache(object):
+    """
+    The values and version hashes of one memoizer kept in a request scope,
+    and the values waiting to be stored, by timeout bucket.
+    """
+
+    __slots__ = ('values', 'versions', 'pending')
+
+    def __init__(self):
+        self.values = {}
+        self.versions = {}
+        self.pending = {}
+
+
+class _RequestScope(object):
+    """
+    The ``_ScopeCache`` of each memoizer used in a request or task.
+    """
+
+    def __init__(self):
+        self._caches = {}
+
+    def cache(self, memoizer):
+        try:
+            return self._caches[memoizer]
+        except KeyError:
+            return self._caches.setdefault(memoizer, _ScopeCache())
+
+    def flush(self):
+        for memoizer, cache in list(self._caches.items()):
+            if cache.pending:
+                memoizer._memoize_flush(cache)
+
+    async def aflush(self):
+        for memoizer, cache in list(self._caches.items()):
+            if cache.pending:
+                await memoizer._amemoize_flush(cache)
+
+
+_current_scope = _ContextVar('memoize_request_scope')
+
+
+class request_scope(contextlib.ContextDecorator):
+    """
+    Keeps the values and version hashes of memoized calls in memory until the
+    block exits, so that calling a memoized function again with the same
+    arguments does not reach the cache backend. Meant for the duration of a
+    request, a task or a management command; ``RequestScopeMiddleware`` does
+    it for requests. Nested scopes share the outermost one.
+
+    Values buffered by memoizers with ``write_buffer_size`` are stored when
+    the scope exits; use ``async with`` in coroutines to store them with the
+    async cache API.
+
+    The scope belongs to the current thread or asyncio task context.
+    """
+
+    def __init__(self):
+        self._tokens = []
+
+    def _recreate_cm(self):
+        #: used as a decorator, each call gets its own instance
+        return self.__class__()
+
+    def __enter__(self):
+        if _current_scope.get() is not None:
+            self._tokens.append(None)
+        else:
+            self._tokens.append(_current_scope.set(_RequestScope()))
+        return self
+
+    def __exit__(self, *exc_info):
+        token = self._tokens.pop()
+        if token is not None:
+            try:
+                _current_scope.get().flush()
+            finally:
+                _current_scope.reset(token)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc_info):
+        token = self._tokens.pop()
+        if token is not None:
+            try:
+                await _current_scope.get().aflush()
+            finally:
+                _current_scope.reset(token)
+        return False
+
+
+class LazyResult(object):
+    """
+    The result of a memoized call made in a ``batch_scope``. It is fetched
+    along with the other pending calls of the scope when first needed.
+    """
+
+    __slots__ = ('_batch', '_value', '_error', 'resolved')
+
+    def __init__(self, batch):
+        self._batch = batch
+        self._value = None
+        self._error = None
+        self.resolved = False
+
+    def get(self):
+        """
+        Returns the value of the call, or raises what the function raised.
+        """
+        if not self.resolved:
+            self._batch.dispatch()
+        if self._error is not None:
+            raise self._error
+        return _memoized_result(self._value)
+
+    def _set(self, value=None, error=None):
+        self._value = value
+        self._error = error
+        self.resolved = True
+
+    def __repr__(self):
+        if not self.resolved:
+            return '<LazyResult pending>'
+        return '<LazyResult %r>' % (self._error or self._value,)
+
+
+class _BatchCall(object):
+    """
+    A memoized call waiting in a batch. ``cache_key`` is known at once with
+    ``combined_lookup``, otherwise ``make_key`` builds it once the version
+    hashes are known. ``lookup`` returns a value kept in memory or the
+    default cache value, ``finish`` turns the fetched entry into the value, and
+    ``fallback`` calls the function when the cache backend fails.
+    """
+
+    __slots__ = ('memoizer', 'version_keys', 'version_timeout', 'cache_key',
+                 'make_key', 'lookup', 'finish', 'fallback', 'result',
+                 'version_data', 'entry')
+
+    def __init__(self, memoizer, version_keys, version_timeout, cache_key,
+                 make_key, lookup, finish, fallback, result):
+        self.memoizer = memoizer
+        self.version_keys = version_keys
+        self.version_timeout = version_timeout
+        self.cache_key = cache_key
+        self.make_key = make_key
+        self.lookup = lookup
+        self.finish = finish
+        self.fallback = fallback
+        self.result = result
+        self.version_data = None
+        self.entry = None
+
+
+_MISSING = object()
+
+
+class _Batch(object):
+    """
+    The memoized calls of a ``batch_scope`` waiting to be fetched.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def add(self, call):
+        self.pending.append(call)
+        return call.result
+
+    def dispatch(self):
+        """
+        Fetches the pending calls, with one ``get_many`` per cache backend
+        for their version hashes and one for their values. Functions run on
+        a miss see no batch, so their own memoized calls return values.
+        """
+        token = _current_batch.set(None)
+        try:
+            while self.pending:
+                calls, self.pending = self.pending, []
+                groups = OrderedDict()
+                for call in calls:
+                    groups.setdefault(id(call.memoizer.cache),
+                                      []).append(call)
+                for group in groups.values():
+                    self._resolve(group)
+        finally:
+            _current_batch.reset(token)
+
+    def _resolve(self, group):
+        try:
+            self._fetch(group)
+        except Exception:
+            if settings.DEBUG:
+                raise
+            logger.exception("Exception possibly due to cache backend.")
+            self._finish(group, lambda call: call.fallback())
+            return
+
+        self._finish(group, lambda call: call.finish(
+            call.cache_key, call.entry, call.version_data
+        ))
+
+    def _finish(self, group, finish):
+        """
+        Resolves the pending calls of ``group`` with ``finish``, once per
+        memoizer and cache key: calls repeated in the batch share the result
+        of the first one.
+        """
+        first_calls = {}
+        for call in group:
+            if call.result.resolved:
+                continue
+            key = (call.memoizer, call.cache_key) \
+                if call.cache_key is not None else call
+            first = first_calls.setdefault(key, call)
+            if first is not call:
+                call.result._set(first.result._value, first.result._error)
+                continue
+            try:
+                call.result._set(finish(call))
+            except Exception as e:
+                call.result._set(error=e)
+
+    def _fetch(self, group):
+        """
+        Fetches the entries of the calls of ``group``, which share a cache
+        backend, into ``call.entry`` unless they are kept in memory.
+        """
+        get_many = group[0].memoizer.get_many
+        known = {}
+        created = {}
+
+        #: with combined_lookup the value keys do not depend on the versions
+        fetch_keys = OrderedDict()
+        for call in group:
+            if call.cache_key is not None:
+                rv = call.lookup(call.cache_key)
+                if rv is not call.memoizer.default_cache_value:
+                    call.result._set(rv)
+                    continue
+                fetch_keys[call.cache_key] = None
+            versions = known.setdefault(call.memoizer, {})
+            versions.update(call.memoizer._memoize_known_versions(
+                [key for key in call.version_keys if key not in versions]
+            ))
+            fetch_keys.update(
+                (key, None) for key in call.version_keys
+                if key not in versions
+            )
+        fetched = dict(zip(fetch_keys, get_many(*fetch_keys))) \
+            if fetch_keys else {}
+
+        value_keys = OrderedDict()
+        for call in group:
+            if call.result.resolved:
+                continue
+            memoizer = call.memoizer
+            versions = known[memoizer]
+            found = dict(
+                (key, fetched[key]) for key in call.version_keys
+                if key not in versions and fetched.get(key) is not None
+            )
+            if found:
+                memoizer._memoize_remember_versions(found)
+                versions.update(found)
+            missing = dict(
+                (key, created.setdefault(
+                    key, memoizer._memoize_make_version_hash()
+                ))
+                for key in call.version_keys if key not in versions
+            )
+            if missing:
+                memoizer.set_many(missing, timeout=call.version_timeout)
+                memoizer._memoize_remember_versions(missing)
+                versions.update(missing)
+            call.version_data = ''.join(versions[key]
+                                        for key in call.version_keys)
+
+            if call.cache_key is not None:
+                call.entry = fetched[call.cache_key]
+                continue
+            with memoizer._memoize_prefetched_versions(versions):
+                call.cache_key = call.make_key()
+            rv = call.lookup(call.cache_key)
+            if rv is not memoizer.default_cache_value:
+                call.result._set(rv)
+            else:
+                value_keys[call.cache_key] = None
+
+        if value_keys:
+            fetched = dict(zip(value_keys,
+                               get_many(*value_keys, default=_MISSING)))
+            for call in group:
+                if not call.result.resolved and call.cache_key in fetched:
+                    entry = fetched[call.cache_key]
+                    call.entry = call.memoizer.default_cache_value \
+                        if entry is _MISSING else entry
+
+
+_current_batch = _ContextVar('memoize_batch_scope')
+
+
+class batch_scope(contextlib.ContextDecorator):
+    """
+    Makes the memoized calls of the block return a ``LazyResult`` instead of
+    their value, as a DataLoader does. The version hashes and values of the
+    pending calls, across functions and memoizers sharing a cache backend,
+    are fetched together when a result is first needed, when ``tick()`` is
+    called or when the block exits. Nested scopes share the outermost one.
+
+    Coroutine functions and ``many()`` are not batched.
+    """
+
+    def __init__(self):
+        self._tokens = []
+        self._batch = None
+
+    def _recreate_cm(self):
+        #: used as a decorator, each call gets its own instance
+        return self.__class__()
+
+    def __enter__(self):
+        batch = _current_batch.get()
+        if batch is not None:
+            self._tokens.append(None)
+        else:
+            batch = _Batch()
+            self._tokens.append(_current_batch.set(batch))
+        self._batch = batch
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        token = self._tokens.pop()
+        if token is not None:
+            _current_batch.reset(token)
+            if exc_type is None:
+                self._batch.dispatch()
+        return False
+
+    def tick(self):
+        """
+        Fetches the calls pending in the scope.
+        """
+        if self._batch is not None:
+            self._batch.dispatch()
+
+
+class _NoPhase(object):
+    """
+    Context manager standing for the phases of calls that are not traced.
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_PHASE = _NoPhase()
+
+
+class _CallTrace(object):
+    """
+    The root span of a traced memoized call and the tracer it comes from.
+    """
+
+    __slots__ = ('tracer', 'span')
+
+    def __init__(self, tracer, span):
+        self.tracer = tracer
+        self.span = span
+
+    def set(self, key, value):
+        self.span.set_attribute(key, value)
+
+
+def _phase(trace, name):
+    """
+    Returns a context manager running a child span of ``trace`` named
+    ``name``, or doing nothing if the call is not traced.
+    """
+    if trace is None:
+        return _NO_PHASE
+    return trace.tracer.start_as_current_span(name)
+
+
+class RecordedSpan(object):
+    """
+    A span recorded by ``InMemoryTracer``.
+    """
+
+    def __init__(self, name, attributes=None, parent=None):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.end = None
+        self.exception = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return '<RecordedSpan %s %r>' % (self.name, self.attributes)
+
+
+class InMemoryTracer(object):
+    """
+    Tracer keeping the finished spans in ``spans``, e.g. for tests. It has
+    the ``start_as_current_span`` method of OpenTelemetry tracers, which can
+    be used in its place.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._current = _ContextVar('memoize_span')
+
+    def current_span(self):
+        return self._current.get()
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        span = RecordedSpan(name, attributes, parent=self.current_span())
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.exception = e
+            raise
+        finally:
+            span.end = time.perf_counter()
+            self._current.reset(token)
+            with self._lock:
+                self.spans.append(span)
+
+    def children(self, span):
+        """
+        Returns the finished spans whose parent is ``span``, in the order they
+        started.
+        """
+        with self._lock:
+            children = [s for s in self.spans if s.parent is span]
+        return sorted(children, key=lambda s: s.start)
+
+    def clear(self):
+        with self._lock:
+            del self.spans[:]
+
+
+#: The live ``WriteBehind`` queues, flushed at exit.
+_write_behind_queues = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_write_behind_queues():
+    for queue in list(_write_behind_queues):
+        queue.flush(queue.block_timeout)
+
+
+class WriteBehind(object):
+    """
+    Bounded queue of memoized values stored by a background thread, so that
+    callers do not wait for the cache backend after a miss. Queued values
+    are stored in ``set_many`` batches of at most ``batch_size`` values.
+
+    When ``max_queue`` values are waiting, ``policy`` decides: ``'drop'``
+    drops the new value, ``'drop_oldest'`` the oldest queued one, and
+    ``'block'`` waits at most ``block_timeout`` seconds for room before
+    dropping the new value.
+
+    ``queued`` counts the values queued, ``written`` the values stored and
+    ``dropped`` the values dropped, including those of failed batches.
+
+    The thread is started on first use, and again in processes forked
+    afterwards, e.g. by a preloading gunicorn; values queued before the fork
+    are only stored by the parent.
+    """
+
+    policies = ('drop', 'drop_oldest', 'block')
+
+    def __init__(self, max_queue=1000, batch_size=100, policy='drop',
+                 block_timeout=1.0):
+        if policy not in self.policies:
+            raise ValueError("policy must be one of %s"
+                             % ', '.join(self.policies))
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self._reset()
+        _write_behind_queues.add(self)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = deque()
+        self._writing = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, memoizer, cache_key, value, timeout, bucket, data=None):
+        """
+        Queues ``value`` to be stored under ``cache_key`` by ``memoizer``.
+        Values of the same ``bucket`` in a batch are stored together, with
+        the longest of their timeouts. ``data`` is the pickle of ``value``, if
+        already known. Returns whether it was queued.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                if self.policy == 'drop_oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                elif self.policy != 'block' or not self._cond.wait_for(
+                        lambda: len(self._queue) < self.max_queue,
+                        self.block_timeout):
+                    self.dropped += 1
+                    return False
+
+            self._queue.append((memoizer, cache_key, value, timeout, bucket,
+                                data))
+            self.queued += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='memoize-write-behind')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Waits for the queued values to be stored. Returns whether they were.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._writing, timeout
+            )
+
+    def discard(self, memoizer, cache_key=None):
+        """
+        Drops the queued values of ``memoizer``, or only the one of
+        ``cache_key``, and waits at most ``block_timeout`` seconds for the
+        batch being stored, so that they do not overwrite an invalidation
+        that follows. Returns how many were dropped.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._cond:
+            kept = deque(
+                entry for entry in self._queue
+                if entry[0] is not memoizer or
+                cache_key is not None and entry[1] != cache_key
+            )
+            dropped = len(self._queue) - len(kept)
+            self._queue = kept
+            self.dropped += dropped
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: not self._writing, self.block_timeout)
+        return dropped
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue)
+                batch = [self._queue.popleft() for _ in
+                         range(min(self.batch_size, len(self._queue)))]
+                self._writing = len(batch)
+                self._cond.notify_all()
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._writing = 0
+                    self._cond.notify_all()
+                close_old_connections()
+
+    def _write(self, batch):
+        groups = OrderedDict()
+        for memoizer, cache_key, value, timeout, bucket, data in batch:
+            mapping, timeouts, pickles = groups.setdefault(
+                (memoizer, bucket), ({}, [], {})
+            )
+            mapping[cache_key] = value
+            timeouts.append(timeout)
+            pickles[cache_key] = data
+
+        for (memoizer, _), (mapping, timeouts, pickles) in groups.items():
+            try:
+                memoizer._memoize_set_many(
+                    mapping, timeout=memoizer._memoize_max_timeout(timeouts),
+                    pickles=pickles
+                )
+            except Exception:
+                logger.exception("Exception while writing memoized values.")
+                with self._cond:
+                    self.dropped += len(mapping)
+            else:
+                with self._cond:
+                    self.written += len(mapping)
+
+
+def _run_steps(steps):
+    """
+    Runs ``steps``, a generator yielding the cache operations to make, as
+    callables without arguments, and taking back their results, or their
+    exceptions thrown in. Returns the value the generator returns.
+    """
+    send, value = steps.send, None
+    while True:
+        try:
+            step = send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            send, value = steps.send, step()
+        except BaseException as e:
+            send, value = steps.throw, e
+
+
+async def _arun_steps(steps):
+    """
+    Same as ``_run_steps`` for steps returning awaitables.
+    """
+    send, value = steps.send, None
+    while True:
+        try:
+            step = send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            send, value = steps.send, await step()
+        except BaseException as e:
+            send, value = steps.throw, e
+
+
+class _MemoizedFunction(object):
+    """
+    The caching logic of a function memoized by ``Memoizer.memoize``, with
+    the options it was given. ``wrapper`` is the decorated function, whose
+    ``cache_timeout`` and ``make_cache_key`` may be replaced.
+    """
+
+    def __init__(self, memoizer, f, unless=None, min_time=0,
+                 local_timeout=None, stale_ttl=None, early_recompute=None,
+                 ttl_jitter=None, ignore=None, key_args=None,
+                 compress_dict=None, serializer=None, cache_exceptions=(),
+                 exception_ttl=None):
+        self.memoizer = memoizer
+        self.f = f
+        self.unless = unless
+        self.min_time = min_time
+        self.local_timeout = local_timeout
+        self.stale_ttl = stale_ttl
+        self.early_recompute = early_recompute
+        self.ttl_jitter = ttl_jitter
+        self.compress_dict = compress_dict
+        self.serializer = serializer
+        self.cache_exceptions = cache_exceptions
+        self.exception_ttl = exception_ttl
+        self.plan = memoizer._memoize_key_plan(f, ignore=ignore,
+                                               key_args=key_args)
+        self.stats_name = self.plan.namespace()[0]
+        #: whether stored values carry their own expiry time
+        self.soft = bool(stale_ttl or early_recompute or ttl_jitter)
+        self.wrapper = None
+
+    def bypassed(self, trace=None):
+        if not (callable(self.unless) and self.unless() is True):
+            return False
+        if trace is not None:
+            trace.set('memoize.bypass', True)
+        return True
+
+    def make_cache_key(self, args, kwargs):
+        return self.wrapper.make_cache_key(self.f, *args, **kwargs)
+
+    def version_timeout(self):
+        timeout = self.wrapper.cache_timeout
+        if self.stale_ttl:
+            #: the version has to outlive the values served stale
+            timeout = self.memoizer._memoize_soft_timeout(
+                timeout, self.stale_ttl
+            )[1]
+        return timeout
+
+    def cache_local_timeout(self):
+        return self.memoizer._memoize_local_timeout(self.wrapper.cache_timeout,
+                                                    self.local_timeout)
+
+    def backend_error(self, e, trace=None):
+        """
+        Records an exception of the cache backend being handled, and raises
+        it again in DEBUG.
+        """
+        stats = self.memoizer.stats
+        if stats is not None:
+            stats.incr(self.stats_name, 'errors')
+        if trace is not None:
+            trace.set('memoize.error', e.__class__.__name__)
+        if settings.DEBUG:
+            raise
+        logger.exception("Exception possibly due to cache backend.")
+
+    def lookup(self, cache_key, scope, local_timeout, trace=None):
+        """
+        Returns the value kept for ``cache_key`` in the request scope or in
+        the local cache, or the default cache value.
+        """
+        memoizer = self.memoizer
+        stats = memoizer.stats
+        default = memoizer.default_cache_value
+        if scope is not None:
+            rv = scope.values.get(cache_key, default)
+            if rv is not default:
+                if stats is not None:
+                    stats.incr(self.stats_name, 'scope_hits')
+                    stats.incr(self.stats_name, 'hits')
+                if trace is not None:
+                    trace.set('memoize.hit', True)
+                    trace.set('memoize.scope_hit', True)
+                return rv
+        if local_timeout:
+            rv = memoizer.local_cache.get(cache_key, default)
+            if rv is not default:
+                if stats is not None:
+                    stats.incr(self.stats_name, 'local_hits')
+                    stats.incr(self.stats_name, 'hits')
+                if trace is not None:
+                    trace.set('memoize.hit', True)
+                    trace.set('memoize.local_hit', True)
+                if scope is not None:
+                    scope.values[cache_key] = rv
+                return rv
+        return default
+
+    def record_lookup(self, rv, expired, trace):
+        hit = rv is not self.memoizer.default_cache_value
+        stats = self.memoizer.stats
+        if stats is not None:
+            stats.incr(self.stats_name, 'hits' if hit else 'misses')
+        if trace is not None:
+            trace.set('memoize.hit', hit)
+            if expired:
+                trace.set('memoize.stale', True)
+
+    def unwrap(self, rv, stale):
+        """
+        Returns the value to serve or the default cache value, the outdated
+        value or the default cache value, and whether the value is past its
+        fresh time.
+        """
+        memoizer = self.memoizer
+        expired = False
+        if isinstance(rv, _CompressedValue):
+            rv = memoizer._memoize_decompress(rv, self.compress_dict,
+                                              self.stats_name)
+        if isinstance(stale, _CompressedValue):
+            stale = memoizer._memoize_decompress(stale, self.compress_dict,
+                                                 self.stats_name)
+        if isinstance(rv, _SoftValue):
+            if rv.expires is not None:
+                expired = memoizer._memoize_expired(rv, self.early_recompute)
+            rv = rv.value
+            if expired and not self.stale_ttl:
+                #: recomputed early, the current value can still be served
+                #: while another process holds the lease
+                rv, stale = memoizer.default_cache_value, rv
+                expired = False
+        if isinstance(stale, _SoftValue):
+            stale = stale.value
+        serializer = self.serializer or memoizer.serializer
+        if serializer is not None:
+            #: values stored before the serializer was set are served as is
+            if isinstance(rv, bytes):
+                rv = memoizer._memoize_loads(rv, serializer, self.stats_name)
+            if isinstance(stale, bytes):
+                stale = memoizer._memoize_loads(stale, serializer,
+                                                self.stats_name)
+        return rv, stale, expired
+
+    def fetch(self, cache_key, args):
+        """
+        Returns the cached value or the default cache value, the version it
+        is stored for, an outdated value or the default cache value, and
+        whether the value is past its fresh time.
+        """
+        memoizer = self.memoizer
+        if memoizer.combined_lookup:
+            entry, version_data = memoizer._memoize_get_combined(
+                self.f, cache_key, args=args, timeout=self.version_timeout(),
+                plan=self.plan
+            )
+        else:
+            entry, version_data = memoizer.get(cache_key), None
+        if isinstance(entry, _ChunkedValue):
+            entry = memoizer._memoize_unchunk(cache_key, entry,
+                                              memoizer.default_cache_value)
+        return self.fetched(entry, version_data)
+
+    async def afetch(self, cache_key, args, version_keys):
+        """
+        Same as ``fetch``, using the async cache API.
+        """
+        memoizer = self.memoizer
+        if memoizer.combined_lookup:
+            versions, (entry,) = await memoizer._amemoize_prefetch_versions(
+                version_keys, timeout=self.version_timeout(),
+                extra_keys=(cache_key,)
+            )
+            version_data = ''.join(versions[key] for key in version_keys)
+        else:
+            entry, version_data = await memoizer.aget(cache_key), None
+        if isinstance(entry, _ChunkedValue):
+            entry = await memoizer._amemoize_unchunk(
+                cache_key, entry, memoizer.default_cache_value
+            )
+        return self.fetched(entry, version_data)
+
+    def fetched(self, entry, version_data):
+        """
+        Returns what ``fetch`` returns from the entry stored for a call, or
+        the default cache value, and the current version for
+        ``combined_lookup``.
+        """
+        memoizer = self.memoizer
+        default = memoizer.default_cache_value
+        if memoizer.combined_lookup:
+            rv, stale = memoizer._memoize_combined_entry(
+                None if entry is default else entry, version_data
+            )
+        else:
+            rv, stale = entry, default
+        rv, stale, expired = self.unwrap(rv, stale)
+        return rv, version_data, stale, expired
+
+    def run(self, args, kwargs):
+        """
+        Returns the value of the function, or its memoized exception, and the
+        time it took.
+        """
+        start_time = time.time()
+        try:
+            rv = self.f(*args, **kwargs)
+        except self.cache_exceptions as e:
+            rv = _CachedException(e)
+        return rv, time.time() - start_time
+
+    async def arun(self, args, kwargs):
+        """
+        Same as ``run`` for coroutine functions.
+        """
+        start_time = time.time()
+        try:
+            rv = await self.f(*args, **kwargs)
+        except self.cache_exceptions as e:
+            rv = _CachedException(e)
+        return rv, time.time() - start_time
+
+    def to_store(self, rv, elapsed_time, version_data):
+        """
+        Records the time a value took to compute, and returns what to store in
+        the cache backend for it, the timeout to store it with and its pickle
+        if needed for compression, chunking or stats, or None if it took
+        ``min_time`` or less.
+        """
+        memoizer = self.memoizer
+        stats = memoizer.stats
+        if stats is not None:
+            stats.observe(self.stats_name, 'compute_time', elapsed_time)
+        if elapsed_time <= self.min_time:
+            return None
+
+        value = rv
+        timeout = self.wrapper.cache_timeout
+        if isinstance(rv, _CachedException):
+            #: stored as is, for the serializer may not handle it
+            if self.exception_ttl is not None:
+                timeout = self.exception_ttl
+        else:
+            serializer = self.serializer or memoizer.serializer
+            if serializer is not None:
+                value = serializer.dumps(value)
+        if self.soft:
+            expires, timeout = memoizer._memoize_soft_timeout(
+                timeout, self.stale_ttl, self.ttl_jitter
+            )
+            value = _SoftValue(expires, value, elapsed_time)
+        #: pickled once here, for all of the steps below
+        data = None
+        if memoizer.compress_threshold is not None:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            compressed = memoizer._memoize_compress(
+                value, self.compress_dict, self.stats_name, data=data
+            )
+            if compressed is not value:
+                value, data = compressed, None
+        if memoizer.combined_lookup:
+            value, data = (version_data, value), None
+        if data is None:
+            if memoizer.max_item_size is not None:
+                data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            elif stats is not None or memoizer.tracer is not None:
+                try:
+                    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    #: only the size is not recorded
+                    pass
+        return value, timeout, data
+
+    def record_set(self, pickles, start, trace=None):
+        """
+        Records the time taken by the set started at ``start`` and the size
+        of each of ``pickles``, the pickles of the values stored or None.
+        """
+        stats = self.memoizer.stats
+        if stats is None and trace is None:
+            return
+        if stats is not None:
+            stats.observe(self.stats_name, 'set_time',
+                          time.perf_counter() - start)
+        for data in pickles:
+            if data is None:
+                continue
+            size = len(data)
+            if stats is not None:
+                stats.observe(self.stats_name, 'size', size)
+            if trace is not None:
+                trace.set('memoize.size', size)
+
+    def stored(self, cache_key, rv, data, start, local_timeout, args,
+               trace=None):
+        """
+        Does the bookkeeping of a value just stored, whose pickle is
+        ``data``.
+        """
+        self.record_set((data,), start, trace)
+        if local_timeout:
+            self.memoizer._memoize_local_set(cache_key, rv, local_timeout,
+                                             self.plan, args=args)
+
+    def compute(self, cache_key, version_data, local_timeout, args, kwargs,
+                trace=None):
+        with _phase(trace, 'memoize.compute'):
+            rv, elapsed_time = self.run(args, kwargs)
+        try:
+            stored = self.to_store(rv, elapsed_time, version_data)
+            if stored is not None:
+                start = time.perf_counter()
+                with _phase(trace, 'memoize.set'):
+                    self.memoizer._memoize_store(cache_key, stored[0],
+                                                 stored[1], soft=self.soft,
+                                                 data=stored[2])
+                self.stored(cache_key, rv, stored[2], start, local_timeout,
+                            args, trace)
+        except Exception as e:
+            self.backend_error(e, trace)
+        return rv
+
+    def leased(self, cache_key, version_data, local_timeout, args, kwargs,
+               stale, trace=None):
+        """
+        Returns ``compute`` for the call, guarded by a lease when
+        ``lease_timeout`` is set.
+        """
+        return self.memoizer._memoize_lease(
+            cache_key,
+            functools.partial(self.compute, cache_key, version_data,
+                              local_timeout, args, kwargs, trace=trace),
+            functools.partial(self.fetch, cache_key, args),
+            stale
+        )
+
+    def compute_missing(self, cache_key, version_data, local_timeout, args,
+                        kwargs, stale, trace=None):
+        """
+        Computes and stores a missing value, once per process with
+        ``single_flight`` and once across processes with ``lease_timeout``.
+        """
+        single_flight = self.memoizer.single_flight
+        compute = self.leased(cache_key, version_data, local_timeout, args,
+                              kwargs, stale, trace)
+        if single_flight is not None:
+            return single_flight.run(cache_key, compute)
+        return compute()
+
+    async def acompute(self, cache_key, version_data, local_timeout, args,
+                       kwargs, trace=None):
+        """
+        Same as ``compute``, using the async cache API.
+        """
+        with _phase(trace, 'memoize.compute'):
+            rv, elapsed_time = await self.arun(args, kwargs)
+        try:
+            stored = self.to_store(rv, elapsed_time, version_data)
+            if stored is not None:
+                start = time.perf_counter()
+                with _phase(trace, 'memoize.set'):
+                    await self.memoizer._amemoize_store(
+                        cache_key, stored[0], stored[1], soft=self.soft,
+                        data=stored[2]
+                    )
+                self.stored(cache_key, rv, stored[2], start, local_timeout,
+                            args, trace)
+        except Exception as e:
+            self.backend_error(e, trace)
+        return rv
+
+    def aleased(self, cache_key, version_data, local_timeout, args, kwargs,
+                version_keys, stale, trace=None):
+        """
+        Same as ``leased``, returning a coroutine function.
+        """
+        memoizer = self.memoizer
+        compute = functools.partial(self.acompute, cache_key, version_data,
+                                    local_timeout, args, kwargs, trace=trace)
+        if not memoizer.lease_timeout:
+            return compute
+        return functools.partial(
+            memoizer._amemoize_leased, cache_key, compute,
+            functools.partial(self.afetch, cache_key, args, version_keys),
+            stale
+        )
+
+    async def acompute_missing(self, cache_key, version_data, local_timeout,
+                               args, kwargs, version_keys, stale, trace=None):
+        """
+        Same as ``compute_missing``, with ``async_flights`` in place of
+        ``single_flight``.
+        """
+        return await self.memoizer.async_flights.run(cache_key, self.aleased(
+            cache_key, version_data, local_timeout, args, kwargs,
+            version_keys, stale, trace
+        ))
+
+    @staticmethod
+    async def arefresh(compute):
+        try:
+            await compute()
+        except Exception:
+            logger.exception("Exception while refreshing a memoized value.")
+
+    def build_cache_key(self, args, kwargs, trace):
+        """
+        Builds the cache key of a call. When it is traced, the versions are
+        fetched first so that the version lookup and the key hashing are
+        separate phases.
+        """
+        memoizer = self.memoizer
+        if trace is None:
+            return self.wrapper.make_cache_key(self.f, *args, **kwargs)
+        if memoizer.combined_lookup:
+            with _phase(trace, 'memoize.key'):
+                return self.make_cache_key(args, kwargs)
+
+        with _phase(trace, 'memoize.version'):
+            versions = memoizer._memoize_prefetch_versions(
+                memoizer._memoize_version_keys(self.f, args=args,
+                                               plan=self.plan)[1],
+                timeout=self.version_timeout()
+            )
+        with memoizer._memoize_prefetched_versions(versions), \
+                _phase(trace, 'memoize.key'):
+            return self.make_cache_key(args, kwargs)
+
+    async def abuild_cache_key(self, args, kwargs, trace):
+        """
+        Same as ``build_cache_key``, using the async cache API. Returns the
+        version keys of the call as well.
+        """
+        memoizer = self.memoizer
+        version_keys = memoizer._memoize_version_keys(self.f, args=args,
+                                                      plan=self.plan)[1]
+        if memoizer.combined_lookup:
+            with _phase(trace, 'memoize.key'):
+                return self.make_cache_key(args, kwargs), version_keys
+
+        with _phase(trace, 'memoize.version'):
+            versions, _ = await memoizer._amemoize_prefetch_versions(
+                version_keys, timeout=self.version_timeout()
+            )
+        #: no await in this block, the versions are not seen by other tasks
+        with memoizer._memoize_prefetched_versions(versions), \
+                _phase(trace, 'memoize.key'):
+            return self.make_cache_key(args, kwargs), version_keys
+
+    def keyed(self, cache_key, scope, start, trace):
+        """
+        Records the time taken to build ``cache_key`` since ``start``, and
+        returns the local timeout of the call and the value kept for it in
+        the request scope or the local cache, or the default cache value.
+        """
+        stats = self.memoizer.stats
+        if stats is not None:
+            stats.observe(self.stats_name, 'key_time',
+                          time.perf_counter() - start)
+        local_timeout = self.cache_local_timeout()
+        return local_timeout, self.lookup(cache_key, scope, local_timeout,
+                                          trace)
+
+    def got(self, cache_key, rv, expired, start, local_timeout, args):
+        """
+        Records the time taken to fetch ``rv`` since ``start``, and keeps it
+        in the local cache if it is fresh.
+        """
+        memoizer = self.memoizer
+        if memoizer.stats is not None:
+            memoizer.stats.observe(self.stats_name, 'get_time',
+                                   time.perf_counter() - start)
+        if local_timeout and not expired and \
+                rv is not memoizer.default_cache_value:
+            memoizer._memoize_local_set(cache_key, rv, local_timeout,
+                                        self.plan, args=args)
+
+    def result(self, cache_key, scope, rv):
+        if scope is not None:
+            scope.values[cache_key] = rv
+        return _memoized_result(rv)
+
+    def __call__(self, args, kwargs):
+        batch = _current_batch.get()
+        if batch is not None:
+            return self.batch_call(batch, args, kwargs)
+        tracer = self.memoizer.tracer
+        if tracer is not None and self.memoizer._memoize_sampled():
+            with tracer.start_as_current_span(
+                'memoize', attributes={'memoize.function': self.stats_name}
+            ) as span:
+                return self.cached_call(args, kwargs,
+                                        _CallTrace(tracer, span))
+        return self.cached_call(args, kwargs, None)
+
+    async def acall(self, args, kwargs):
+        tracer = self.memoizer.tracer
+        if tracer is not None and self.memoizer._memoize_sampled():
+            with tracer.start_as_current_span(
+                'memoize', attributes={'memoize.function': self.stats_name}
+            ) as span:
+                return await self.acached_call(args, kwargs,
+                                               _CallTrace(tracer, span))
+        return await self.acached_call(args, kwargs, None)
+
+    def cached_call(self, args, kwargs, trace):
+        #: bypass cache
+        if self.bypassed(trace):
+            return self.f(*args, **kwargs)
+
+        memoizer = self.memoizer
+        scope = memoizer._memoize_scope()
+        # try to fetch the function's return value from the cache
+        try:
+            start = time.perf_counter()
+            cache_key = self.build_cache_key(args, kwargs, trace)
+            local_timeout, rv = self.keyed(cache_key, scope, start, trace)
+        except Exception as e:
+            self.backend_error(e, trace)
+            return self.f(*args, **kwargs)
+        #: out of the try block, the value may be an exception to raise
+        if rv is not memoizer.default_cache_value:
+            return _memoized_result(rv)
+
+        try:
+            start = time.perf_counter()
+            with _phase(trace, 'memoize.get'):
+                rv, version_data, stale, expired = self.fetch(cache_key, args)
+            self.got(cache_key, rv, expired, start, local_timeout, args)
+            if expired:
+                #: serve the value as is and refresh it in the background
+                memoizer.refresher.submit(cache_key, self.leased(
+                    cache_key, version_data, local_timeout, args, kwargs, rv
+                ))
+        except Exception as e:
+            self.backend_error(e, trace)
+            return self.f(*args, **kwargs)
+
+        self.record_lookup(rv, expired, trace)
+
+        # if a cache miss occurs, run the function from scratch
+        # and cache the resulting return value
+        if rv is memoizer.default_cache_value:
+            rv = self.compute_missing(cache_key, version_data, local_timeout,
+                                      args, kwargs, stale, trace)
+        return self.result(cache_key, scope, rv)
+
+    async def acached_call(self, args, kwargs, trace):
+        """
+        Same as ``cached_call`` for coroutine functions, using the async
+        cache API.
+        """
+        #: bypass cache
+        if self.bypassed(trace):
+            return await self.f(*args, **kwargs)
+
+        memoizer = self.memoizer
+        scope = memoizer._memoize_scope()
+        # try to fetch the function's return value from the cache
+        try:
+            start = time.perf_counter()
+            cache_key, version_keys = await self.abuild_cache_key(
+                args, kwargs, trace
+            )
+            local_timeout, rv = self.keyed(cache_key, scope, start, trace)
+        except Exception as e:
+            self.backend_error(e, trace)
+            return await self.f(*args, **kwargs)
+        #: out of the try block, the value may be an exception to raise
+        if rv is not memoizer.default_cache_value:
+            return _memoized_result(rv)
+
+        try:
+            start = time.perf_counter()
+            with _phase(trace, 'memoize.get'):
+                rv, version_data, stale, expired = await self.afetch(
+                    cache_key, args, version_keys
+                )
+            self.got(cache_key, rv, expired, start, local_timeout, args)
+            if expired:
+                #: serve the value as is and refresh it in the background
+                memoizer.async_flights.submit(cache_key, functools.partial(
+                    self.arefresh, self.aleased(
+                        cache_key, version_data, local_timeout, args, kwargs,
+                        version_keys, rv
+                    )
+                ))
+        except Exception as e:
+            self.backend_error(e, trace)
+            return await self.f(*args, **kwargs)
+
+        self.record_lookup(rv, expired, trace)
+
+        # if a cache miss occurs, run the function from scratch
+        # and cache the resulting return value
+        if rv is memoizer.default_cache_value:
+            rv = await self.acompute_missing(
+                cache_key, version_data, local_timeout, args, kwargs,
+                version_keys, stale, trace
+            )
+        return self.result(cache_key, scope, rv)
+
+    def many(self, args_list, workers=None):
+        """
+        Returns the values of the function for each item of ``args_list``, in
+        order. Items that are not tuples are passed as the single argument of
+        the function.
+
+        Expired values are served and refreshed in the background. The missing
+        values are stored with one ``set_many``, unless ``single_flight`` or
+        ``lease_timeout`` guard them, in which case they are computed and
+        stored one by one as for single calls.
+        """
+        args_list = [
+            args if isinstance(args, tuple) else (args,)
+            for args in args_list
+        ]
+        if self.bypassed():
+            return [self.f(*args) for args in args_list]
+
+        memoizer = self.memoizer
+        stats = memoizer.stats
+        default = memoizer.default_cache_value
+        scope = memoizer._memoize_scope()
+        local_timeout = self.cache_local_timeout()
+        try:
+            #: fetch the versions of all calls at once
+            version_keys = [
+                memoizer._memoize_version_keys(self.f, args=args,
+                                               plan=self.plan)[1]
+                for args in args_list
+            ]
+            versions = memoizer._memoize_prefetch_versions(
+                [key for keys in version_keys for key in keys],
+                timeout=self.version_timeout()
+            )
+            with memoizer._memoize_prefetched_versions(versions):
+                cache_keys = [self.make_cache_key(args, {})
+                              for args in args_list]
+            version_by_key = dict(zip(cache_keys, (
+                ''.join(versions[key] for key in keys)
+                for keys in version_keys
+            )))
+            args_by_key = dict(zip(cache_keys, args_list))
+
+            results = {}
+            fetch_keys = []
+            for cache_key in OrderedDict.fromkeys(cache_keys):
+                rv = self.lookup(cache_key, scope, local_timeout)
+                if rv is not default:
+                    results[cache_key] = rv
+                else:
+                    fetch_keys.append(cache_key)
+            start = time.perf_counter()
+            fetched = memoizer.get_many(
+                *fetch_keys, default=default
+            ) if fetch_keys else []
+            if stats is not None:
+                stats.observe(self.stats_name, 'get_time',
+                              time.perf_counter() - start)
+
+            for cache_key, rv in zip(fetch_keys, fetched):
+                if isinstance(rv, _ChunkedValue):
+                    rv = memoizer._memoize_unchunk(cache_key, rv, default)
+                if rv is default:
+                    continue
+                if memoizer.combined_lookup:
+                    if rv[0] != version_by_key[cache_key]:
+                        continue
+                    rv = rv[1]
+                rv, _, expired = self.unwrap(rv, default)
+                if rv is default:
+                    continue
+                results[cache_key] = rv
+                if expired:
+                    #: serve the value as is and refresh it in the background
+                    memoizer.refresher.submit(cache_key, self.leased(
+                        cache_key, version_by_key[cache_key], local_timeout,
+                        args_by_key[cache_key], {}, rv
+                    ))
+                elif local_timeout:
+                    memoizer._memoize_local_set(
+                        cache_key, rv, local_timeout, self.plan,
+                        args=args_by_key[cache_key]
+                    )
+        except Exception as e:
+            self.backend_error(e)
+            return [self.f(*args) for args in args_list]
+
+        missing = [key for key in fetch_keys if key not in results]
+        if stats is not None:
+            stats.incr(self.stats_name, 'hits',
+                       len(fetch_keys) - len(missing))
+            stats.incr(self.stats_name, 'misses', len(missing))
+        if memoizer.single_flight is not None or memoizer.lease_timeout:
+            #: computed and stored one by one, under the same guards as
+            #: single calls
+            def compute(cache_key):
+                return self.compute_missing(
+                    cache_key, version_by_key[cache_key], local_timeout,
+                    args_by_key[cache_key], {}, default
+                )
+
+            if workers and len(missing) > 1:
+                with futures.ThreadPoolExecutor(workers) as executor:
+                    results.update(zip(missing,
+                                       executor.map(compute, missing)))
+            else:
+                results.update((key, compute(key)) for key in missing)
+            computed = []
+        elif workers and len(missing) > 1:
+            with futures.ThreadPoolExecutor(workers) as executor:
+                computed = list(executor.map(
+                    lambda key: self.run(args_by_key[key], {}), missing
+                ))
+        else:
+            computed = [self.run(args_by_key[key], {}) for key in missing]
+
+        mapping = {}
+        timeouts = []
+        pickles = {}
+        for cache_key, (rv, elapsed_time) in zip(missing, computed):
+            results[cache_key] = rv
+            stored = self.to_store(rv, elapsed_time, version_by_key[cache_key])
+            if stored is not None:
+                mapping[cache_key] = stored[0]
+                timeouts.append(stored[1])
+                pickles[cache_key] = stored[2]
+
+        try:
+            if mapping:
+                start = time.perf_counter()
+                memoizer._memoize_store_many(mapping, timeouts,
+                                             soft=self.soft, pickles=pickles)
+                self.record_set(pickles.values(), start)
+            if local_timeout:
+                for cache_key in mapping:
+                    memoizer._memoize_local_set(
+                        cache_key, results[cache_key], local_timeout,
+                        self.plan, args=args_by_key[cache_key]
+                    )
+        except Exception as e:
+            self.backend_error(e)
+
+        if scope is not None:
+            scope.values.update(results)
+        return [_memoized_result(results[cache_key])
+                for cache_key in cache_keys]
+
+    def batch_call(self, batch, args, kwargs):
+        """
+        Adds a call to ``batch`` and returns its ``LazyResult``.
+        """
+        result = LazyResult(batch)
+        if self.bypassed():
+            result._set(self.f(*args, **kwargs))
+            return result
+
+        scope = self.memoizer._memoize_scope()
+        local_timeout = self.cache_local_timeout()
+        try:
+            version_keys = self.memoizer._memoize_version_keys(
+                self.f, args=args, plan=self.plan
+            )[1]
+            #: the key does not depend on the versions then
+            cache_key = self.make_cache_key(args, kwargs) \
+                if self.memoizer.combined_lookup else None
+        except Exception as e:
+            self.backend_error(e)
+            result._set(self.f(*args, **kwargs))
+            return result
+
+        return batch.add(_BatchCall(
+            self.memoizer, version_keys, self.version_timeout(), cache_key,
+            functools.partial(self.make_cache_key, args, kwargs),
+            functools.partial(self.lookup, scope=scope,
+                              local_timeout=local_timeout),
+            functools.partial(self.batch_finish, scope, local_timeout, args,
+                              kwargs),
+            functools.partial(self.batch_fallback, args, kwargs),
+            result
+        ))
+
+    def batch_finish(self, scope, local_timeout, args, kwargs, cache_key,
+                     entry, version_data):
+        """
+        Returns the value of a batched call from the entry fetched for it,
+        computing it on a miss.
+        """
+        memoizer = self.memoizer
+        stats = memoizer.stats
+        default = memoizer.default_cache_value
+        rv = default
+        try:
+            if isinstance(entry, _ChunkedValue):
+                entry = memoizer._memoize_unchunk(cache_key, entry, default)
+            if memoizer.combined_lookup:
+                #: a value of another version is a miss, as in many()
+                entry = memoizer._memoize_combined_entry(
+                    None if entry is default else entry, version_data
+                )[0]
+            if entry is not default:
+                rv, _, expired = self.unwrap(entry, default)
+                if expired:
+                    rv = default
+        except Exception as e:
+            self.backend_error(e)
+
+        if rv is default:
+            if stats is not None:
+                stats.incr(self.stats_name, 'misses')
+            rv = self.compute(cache_key, version_data, local_timeout, args,
+                              kwargs)
+        else:
+            if stats is not None:
+                stats.incr(self.stats_name, 'hits')
+            if local_timeout:
+                memoizer._memoize_local_set(cache_key, rv, local_timeout,
+                                            self.plan, args=args)
+        if scope is not None:
+            scope.values[cache_key] = rv
+        return rv
+
+    def batch_fallback(self, args, kwargs):
+        stats = self.memoizer.stats
+        if stats is not None:
+            stats.incr(self.stats_name, 'errors')
+        return self.f(*args, **kwargs)
+
+
+class Memoizer(object):
+    """
+    This class is used to control the memoizer objects.
+
+    :param version_cache_timeout: Default: None. If set, the version hashes
+                                  of memoized functions are also kept in
+                                  process for that many seconds, saving a
+                                  round trip to the cache backend on most
+                                  calls. Invalidations made by other processes
+                                  may be seen that much later.
+    :param combined_lookup: Default: False. If set, memoized values are
+                            stored under a key that does not include the
+                            function version, together with the version they
+                            were computed for. The versions and the value are
+                            then fetched with a single ``get_many``.
+    :param local_cache_timeout: Default: None. If set, memoized values are
+                                also kept in process for at most that many
+                                seconds and served from there before the
+                                cache backend is asked.
+    :param local_cache_size: Default: 1000. Maximum number of values kept in
+                             process.
+    :param local_cache_max_bytes: Default: None. If set, maximum total size of
+                                  the pickled values kept in process.
+    :param single_flight_timeout: Default: None. If set, threads of this
+                                  process missing the same value wait for
+                                  the one computing it, for at most that many
+                                  seconds.
+    :param lease_timeout: Default: None. If set, a process missing a value
+                          takes a lease on it in the cache backend for that
+                          many seconds; other processes serve the stale
+                          value, if any, or wait for the value meanwhile.
+    :param lease_poll_interval: Default: 0.05. Seconds between the lookups of
+                                a process waiting for a leased value.
+    :param refresh_workers: Default: 2. Number of threads refreshing the
+                            values served stale.
+    :param refresh_queue_size: Default: 100. Maximum number of refreshes
+                               queued or running; further ones are dropped.
+    :param key_hasher: Default: None. If set, a callable taking the function
+                       name, the arguments and the keyword arguments of a
+                       call and returning the hashed part of its cache key,
+                       such as ``CanonicalKeyHasher``. By default the md5 of
+                       their repr is used.
+    :param stats: Default: None. A ``MemoizeStats`` recording the hits,
+                  misses, errors, timings and value sizes of each memoized
+                  function, or True for one without exporters.
+    :param compress_threshold: Default: None. If set, memoized values whose
+                               pickle is at least that many bytes are stored
+                               compressed with zlib.
+    :param compress_level: Default: 6. The zlib compression level.
+    :param max_item_size: Default: None. If set, memoized values whose pickle
+                          is larger than that many bytes are split into
+                          chunks of at most that size, stored under separate
+                          keys along with a manifest.
+    :param write_buffer_size: Default: None. If set, the values computed in
+                              a ``request_scope`` are buffered and stored
+                              with one ``set_many`` per timeout when it
+                              exits, or once that many values are buffered.
+                              Ignored with ``lease_timeout``.
+    :param write_behind: Default: None. A ``WriteBehind`` storing memoized
+                         values from a background thread after a miss, or
+                         True for one with the default limits. Ignored with
+                         ``lease_timeout``.
+    :param serializer: Default: None. If set, an object with ``dumps`` and
+                       ``loads`` methods, such as ``PickleSerializer``,
+                       turning memoized values into the bytes handed to the
+                       cache backend and back.
+    :param tracer: Default: None. If set, a tracer with the
+                   ``start_as_current_span`` method of OpenTelemetry tracers,
+                   such as ``InMemoryTracer``. Memoized calls then emit a
+                   ``memoize`` span with a child span per phase.
+    :param trace_sample_rate: Default: 1.0. Fraction of the calls traced.
+    """
+
+    def __init__(self, cache=default_cache, cache_prefix='memoize',
+                 default_cache_value=DEFAULT_CACHE_OBJECT,
+                 version_cache_timeout=None, combined_lookup=False,
+                 local_cache_timeout=None, local_cache_size=1000,
+                 local_cache_max_bytes=None, single_flight_timeout=None,
+                 lease_timeout=None, lease_poll_interval=0.05,
+                 refresh_workers=2, refresh_queue_size=100, key_hasher=None,
+                 stats=None, tracer=None, trace_sample_rate=1.0,
+                 compress_threshold=None, compress_level=6, serializer=None,
+                 max_item_size=None, write_buffer_size=None,
+                 write_behind=None):
+        self.cache = cache
+        self.cache_prefix = cache_prefix
+        self.default_cache_value = default_cache_value
+        self.combined_lookup = combined_lookup
+        self.key_hasher = key_hasher
+        self.lease_timeout = lease_timeout
+        self.lease_poll_interval = lease_poll_interval
+        self.stats = MemoizeStats() if stats is True else stats
+        self.tracer = tracer
+        self.trace_sample_rate = trace_sample_rate
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.serializer = serializer
+        self.max_item_size = max_item_size
+        self.write_buffer_size = write_buffer_size
+        self.write_behind = WriteBehind() if write_behind is True \
+            else write_behind
+
+        if version_cache_timeout:
+            self.version_cache = LocalVersionCache(version_cache_timeout)
+        else:
+            self.version_cache = None
+
+        if local_cache_timeout:
+            self.local_cache = LocalCache(local_cache_timeout,
+                                          max_entries=local_cache_size,
+                                          max_bytes=local_cache_max_bytes)
+        else:
+            self.local_cache = None
+
+        if single_flight_timeout:
+            self.single_flight = SingleFlight(single_flight_timeout)
+        else:
+            self.single_flight = None
+
+        self._prefetched = threading.local()
+        self.async_flights = AsyncSingleFlight()
+        self.refresher = BackgroundRefresher(max_workers=refresh_workers,
+                                             max_pending=refresh_queue_size)
+
+    def get(self, key):
+        "Proxy function for internal cache object."
+        return self.cache.get(key=key, default=self.default_cache_value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        "Proxy function for internal cache object."
+        self.cache.set(key=key, value=value, timeout=timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT):
+        "Proxy function for internal cache object."
+        return self.cache.add(key=key, value=value, timeout=timeout)
+
+    def delete(self, key):
+        "Proxy function for internal cache object."
+        self.cache.delete(key=key)
+
+    def delete_many(self, *keys):
+        "Proxy function for internal cache object."
+        self.cache.delete_many(keys=keys)
+
+    def clear(self):
+        "Proxy function for internal cache object."
+        if self.write_behind is not None:
+            self.write_behind.discard(self)
+        self.cache.clear()
+        if self.version_cache is not None:
+            self.version_cache.clear()
+        if self.local_cache is not None:
+            self.local_cache.clear()
+        scope = self._memoize_scope()
+        if scope is not None:
+            scope.values.clear()
+            scope.versions.clear()
+
+    def get_many(self, *keys, default=None):
+        """
+        Proxy function for internal cache object. Missing keys map to
+        ``default``, so that passing ``default_cache_value`` tells them apart
+        from stored None values.
+        """
+        d = self.cache.get_many(keys=keys)
+
+        values = []
+        for key in keys:
+            values.append(
+                d.get(key, default)
+            )
+
+        return values
+
+    def set_many(self, mapping, timeout=DEFAULT_TIMEOUT):
+        "Proxy function for internal cache object."
+        self.cache.set_many(data=mapping, timeout=timeout)
+
+    def _memoize_sync_cache(self):
+        """
+        Whether the cache backend lacks the async API of Django 4.0+, in which
+        case the async proxies run the sync ones in a thread.
+        """
+        return not hasattr(self.cache, 'aget')
+
+    async def aget(self, key):
+        "Proxy function for internal cache object."
+        if self._memoize_sync_cache():
+            return await sync_to_async(self.get)(key)
+        return await self.cache.aget(key, default=self.default_cache_value)
+
+    async def aset(self, key, value, timeout=DEFAULT_TIMEOUT):
+        "Proxy function for internal cache object."
+        if self._memoize_sync_cache():
+            return await sync_to_async(self.set)(key, value, timeout=timeout)
+        await self.cache.aset(key, value, timeout=timeout)
+
+    async def aadd(self, key, value, timeout=DEFAULT_TIMEOUT):
+        "Proxy function for internal cache object."
+        if self._memoize_sync_cache():
+            return await sync_to_async(self.add)(key, value, timeout=timeout)
+        return await self.cache.aadd(key, value, timeout=timeout)
+
+    async def adelete(self, key):
+        "Proxy function for internal cache object."
+        if self._memoize_sync_cache():
+            return await sync_to_async(self.delete)(key)
+        await self.cache.adelete(key)
+
+    async def aget_many(self, *keys, default=None):
+        "Proxy function for internal cache object. Same as ``get_many``."
+        if self._memoize_sync_cache():
+            return await sync_to_async(self.get_many)(*keys, default=default)
+        d = await self.cache.aget_many(keys)
+        return [d.get(key, default) for key in keys]
+
+    async def aset_many(self, mapping, timeout=DEFAULT_TIMEOUT):
+        "Proxy function for internal cache object."
+        if self._memoize_sync_cache():
+            return await sync_to_async(self.set_many)(mapping, timeout=timeout)
+        await self.cache.aset_many(mapping, timeout=timeout)
+
+    def _memvname(self, funcname):
+        return hashlib.md5(
+            force_bytes(funcname)
+        ).hexdigest() + "_memver"
+
+    def _memoize_make_version_hash(self):
+        return uuid.uuid4().hex
+
+    def _memoize_key_plan(self, f, ignore=None, key_args=None):
+        """
+        Returns the precomputed key building information for ``f``.
+        """
+        plan = _KeyPlan(f, ignore=ignore, key_args=key_args)
+        if plan.fname is not None:
+            plan.version_key = self._memvname(plan.fname)
+        return plan
+
+    def _memoize_version_keys(self, f, args=None, plan=None):
+        """
+        Returns the namespace of a memoized function or method and the keys
+        of its version hashes: per-function first, then per-instance if any.
+        """
+        if plan is None:
+            fname, instance_fname = function_namespace(f, args=args)
+            version_key = self._memvname(fname)
+        else:
+            fname, instance_fname = plan.namespace(args)
+            version_key = plan.version_key or self._memvname(fname)
+        fetch_keys = [version_key]
+
+        if instance_fname:
+            instance_version_key = self._memvname(instance_fname)
+            fetch_keys.append(instance_version_key)
+
+        return fname, fetch_keys
+
+    def _memoize_version(self, f, args=None,
+                         reset=False, delete=False, timeout=DEFAULT_TIMEOUT,
+                         plan=None):
+        """
+        Updates the hash version associated with a memoized function or method.
+        """
+        fname, fetch_keys = self._memoize_version_keys(f, args=args, plan=plan)
+
+        # Only delete the per-instance version key or per-function version
+        # key but not both.
+        if delete:
+            self.delete(fetch_keys[-1])
+            if self.version_cache is not None:
+                self.version_cache.delete(fetch_keys[-1])
+            scope = self._memoize_scope()
+            if scope is not None:
+                scope.versions.pop(fetch_keys[-1], None)
+            return fname, None
+
+        version_data_list, _ = self._memoize_get_versions(fetch_keys)
+        version_data = self._memoize_update_versions(
+            fetch_keys, version_data_list, reset=reset, timeout=timeout
+        )
+        return fname, version_data
+
+    def _memoize_update_versions(self, fetch_keys, version_data_list,
+                                 reset=False, timeout=DEFAULT_TIMEOUT):
+        """
+        Creates the version hashes missing from ``version_data_list`` and
+        returns the combined version of the function.
+        """
+        dirty = False
+
+        for i, version_data in enumerate(version_data_list):
+            if version_data is None:
+                version_data_list[i] = self._memoize_make_version_hash()
+                dirty = True
+
+        # Only reset the per-instance version or the per-function version
+        # but not both.
+        if reset:
+            fetch_keys = fetch_keys[-1:]
+            version_data_list = [self._memoize_make_version_hash()]
+            dirty = True
+
+        if dirty:
+            versions = dict(zip(fetch_keys, version_data_list))
+            self.set_many(versions, timeout=timeout)
+            self._memoize_remember_versions(versions)
+
+        return ''.join(version_data_list)
+
+    def _memoize_remember_versions(self, versions):
+        """
+        Keeps version hashes just stored in the local version cache and the
+        request scope, if any.
+        """
+        if self.version_cache is not None:
+            self.version_cache.set_many(versions)
+        scope = self._memoize_scope()
+        if scope is not None:
+            scope.versions.update(versions)
+
+    def _memoize_known_versions(self, keys):
+        """
+        Returns the version hashes of ``keys`` known without reaching the
+        cache backend, from the request scope or the local version cache, by
+        key.
+        """
+        known = {}
+        scope = self._memoize_scope()
+        if scope is not None:
+            known.update((key, scope.versions[key]) for key in keys
+                         if key in scope.versions)
+        if self.version_cache is not None:
+            keys = [key for key in keys if key not in known]
+            known.update(
+                (key, value) for key, value in
+                zip(keys, self.version_cache.get_many(keys))
+                if value is not None
+            )
+        return known
+
+    def _memoize_get_versions(self, keys, extra_keys=()):
+        """
+        Fetches the version hashes stored under ``keys``, from the local
+        version cache when possible.
+
+        ``extra_keys`` are fetched from the cache backend in the same
+        request; their values are returned as a second list.
+        """
+        prefetched = getattr(self._prefetched, 'versions', None)
+        if prefetched is not None and not extra_keys and \
+                all(key in prefetched for key in keys):
+            return [prefetched[key] for key in keys], []
+
+        scope = self._memoize_scope()
+        if scope is not None:
+            if not extra_keys and all(key in scope.versions for key in keys):
+                return [scope.versions[key] for key in keys], []
+            versions, extra = self._memoize_fetch_versions(keys, extra_keys)
+            scope.versions.update(
+                (key, value) for key, value in zip(keys, versions)
+                if value is not None
+            )
+            return versions, extra
+
+        return self._memoize_fetch_versions(keys, extra_keys)
+
+    def _memoize_cached_versions(self, keys):
+        """
+        Returns the version hashes of ``keys`` found in the local version
+        cache, None for the others, and the keys of the others.
+        """
+        if self.version_cache is None:
+            return [None] * len(keys), list(keys)
+        versions = self.version_cache.get_many(keys)
+        missing = [key for key, value in zip(keys, versions) if value is None]
+        return versions, missing
+
+    def _memoize_merge_versions(self, keys, versions, missing, values):
+        """
+        Completes ``versions`` with ``values``, fetched for the ``missing``
+        keys followed by the extra keys, and returns them along with the
+        values of the extra keys.
+        """
+        if missing:
+            fetched = dict(zip(missing, values))
+            if self.version_cache is not None:
+                self.version_cache.set_many(fetched)
+            versions = [
+                fetched[key] if value is None else value
+                for key, value in zip(keys, versions)
+            ]
+        return versions, values[len(missing):]
+
+    def _memoize_fetch_versions(self, keys, extra_keys=()):
+        versions, missing = self._memoize_cached_versions(keys)
+        fetch_keys = missing + list(extra_keys)
+        values = self.get_many(*fetch_keys) if fetch_keys else []
+        return self._memoize_merge_versions(keys, versions, missing, values)
+
+    def _memoize_prefetch_versions(self, keys, timeout=DEFAULT_TIMEOUT):
+        """
+        Fetches the version hashes stored under ``keys`` at once, creating the
+        missing ones, and returns them by key.
+        """
+        keys = list(OrderedDict.fromkeys(keys))
+        versions, _ = self._memoize_get_versions(keys)
+        versions = dict(zip(keys, versions))
+
+        missing = dict(
+            (key, self._memoize_make_version_hash())
+            for key, value in versions.items() if value is None
+        )
+        if missing:
+            self.set_many(missing, timeout=timeout)
+            self._memoize_remember_versions(missing)
+            versions.update(missing)
+
+        return versions
+
+    async def _amemoize_get_versions(self, keys, extra_keys=()):
+        """
+        Same as ``_memoize_get_versions``, using the async cache API.
+        """
+        scope = self._memoize_scope()
+        if scope is not None:
+            if not extra_keys and all(key in scope.versions for key in keys):
+                return [scope.versions[key] for key in keys], []
+            versions, extra = await self._amemoize_fetch_versions(keys,
+                                                                  extra_keys)
+            scope.versions.update(
+                (key, value) for key, value in zip(keys, versions)
+                if value is not None
+            )
+            return versions, extra
+
+        return await self._amemoize_fetch_versions(keys, extra_keys)
+
+    async def _amemoize_fetch_versions(self, keys, extra_keys=()):
+        versions, missing = self._memoize_cached_versions(keys)
+        fetch_keys = missing + list(extra_keys)
+        values = await self.aget_many(*fetch_keys) if fetch_keys else []
+        return self._memoize_merge_versions(keys, versions, missing, values)
+
+    async def _amemoize_prefetch_versions(self, keys, timeout=DEFAULT_TIMEOUT,
+                                          extra_keys=()):
+        """
+        Same as ``_memoize_prefetch_versions``, using the async cache API.
+        ``extra_keys`` are fetched in the same request and their values
+        returned as a second list.
+        """
+        keys = list(OrderedDict.fromkeys(keys))
+        versions, extra = await self._amemoize_get_versions(
+            keys, extra_keys=extra_keys
+        )
+        versions = dict(zip(keys, versions))
+
+        missing = dict(
+            (key, self._memoize_make_version_hash())
+            for key, value in versions.items() if value is None
+        )
+        if missing:
+            await self.aset_many(missing, timeout=timeout)
+            self._memoize_remember_versions(missing)
+            versions.update(missing)
+
+        return versions, extra
+
+    @contextlib.contextmanager
+    def _memoize_prefetched_versions(self, versions):
+        """
+        Makes the version lookups of this thread use ``versions``, a mapping
+        of version keys to hashes, for the keys it contains.
+        """
+        previous = getattr(self._prefetched, 'versions', None)
+        self._prefetched.versions = versions
+        try:
+            yield
+        finally:
+            self._prefetched.versions = previous
+
+    def _memoize_get_combined(self, f, cache_key, args=None,
+                              timeout=DEFAULT_TIMEOUT, plan=None):
+        """
+        Fetches the version hashes of a memoized function together with a
+        value stored by ``combined_lookup`` mode, in a single request.
+
+        Returns the entry stored under ``cache_key``, or None, and the
+        current version.
+        """
+        _, fetch_keys = self._memoize_version_keys(f, args=args, plan=plan)
+        version_data_list, (entry,) = self._memoize_get_versions(
+            fetch_keys, extra_keys=(cache_key,)
+        )
+        version_data = self._memoize_update_versions(
+            fetch_keys, version_data_list, timeout=timeout
+        )
+        return entry, version_data
+
+    def _memoize_combined_entry(self, entry, version_data):
+        """
+        Returns the value of a ``combined_lookup`` entry if it was computed
+        for ``version_data``, or the default cache value, and the value if it
+        was computed for another version, or the default cache value.
+        """
+        if entry is None:
+            return self.default_cache_value, self.default_cache_value
+        if entry[0] == version_data:
+            return entry[1], self.default_cache_value
+        return self.default_cache_value, entry[1]
+
+    def _memoize_chunks(self, cache_key, value, data=None):
+        """
+        Returns None if ``value`` fits in one cache item, or the mapping of
+        keys to store it under: its manifest under ``cache_key`` and the
+        chunks of its pickle. ``data`` is that pickle, if already known.
+        """
+        if data is None:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = self.max_item_size
+        if len(data) <= size:
+            return None
+
+        token = uuid.uuid4().hex[:16]
+        mapping = dict(
+            ('%s:chunk:%s:%d' % (cache_key, token, i),
+             data[offset:offset + size])
+            for i, offset in enumerate(range(0, len(data), size))
+        )
+        mapping[cache_key] = _ChunkedValue(
+            token, len(mapping), len(data),
+            hashlib.blake2b(data, digest_size=16).digest()
+        )
+        return mapping
+
+    def _memoize_chunk_keys(self, cache_key, manifest):
+        return ['%s:chunk:%s:%d' % (cache_key, manifest.token, i)
+                for i in range(manifest.count)]
 
+    def _memoize_join_chunks(self, manifest, chunks, default=None):
+        """
+        Returns the value split into ``chunks``, or ``default`` if any of
+        them is missing or they do not match ``manifest``.
+        """
+        if any(chunk is None for chunk in chunks):
+            return default
+        data = b''.join(chunks)
+        if len(data) != manifest.length or manifest.digest != \
+                hashlib.blake2b(data, digest_size=16).digest():
+            return default
+        return pickle.loads(data)
 
-DEFAULT_CACHE_OBJECT = DefaultCacheObject()
+    def _memoize_unchunk(self, cache_key, manifest, default=None):
+        """
+        Fetches the chunks of the value whose manifest is stored under
+        ``cache_key`` with a single ``get_many``, and returns the value, or
+        ``default`` if it cannot be put back together.
+        """
+        chunks = self.get_many(*self._memoize_chunk_keys(cache_key, manifest))
+        return self._memoize_join_chunks(manifest, chunks, default)
 
+    async def _amemoize_unchunk(self, cache_key, manifest, default=None):
+        """
+        Same as ``_memoize_unchunk``, using the async cache API.
+        """
+        chunks = await self.aget_many(
+            *self._memoize_chunk_keys(cache_key, manifest)
+        )
+        return self._memoize_join_chunks(manifest, chunks, default)
 
-def _get_argspec(f):
-    if sys.version_info[:2] >= (3, 0):
-        # inspect has deprecated getargspec since version 3.0
-        argspec = inspect.getfullargspec(f)
-    else:
-        try:
-            argspec = inspect.getargspec(f)
-        except ValueError:
-            # this can happen in python 3.5 when
-            # function has keyword-only arguments or annotations
-            argspec = inspect.getfullargspec(f)
-    return argspec
+    def _memoize_set(self, cache_key, value, timeout=DEFAULT_TIMEOUT,
+                     data=None):
+        """
+        Stores a memoized value, in chunks if it is too large for one item.
+        ``data`` is the pickle of the value, if already known.
+        """
+        if self.max_item_size is not None:
+            mapping = self._memoize_chunks(cache_key, value, data)
+            if mapping is not None:
+                self.set_many(mapping, timeout=timeout)
+                return
+        self.set(cache_key, value, timeout=timeout)
 
+    async def _amemoize_set(self, cache_key, value, timeout=DEFAULT_TIMEOUT,
+                            data=None):
+        """
+        Same as ``_memoize_set``, using the async cache API.
+        """
+        if self.max_item_size is not None:
+            mapping = self._memoize_chunks(cache_key, value, data)
+            if mapping is not None:
+                await self.aset_many(mapping, timeout=timeout)
+                return
+        await self.aset(cache_key, value, timeout=timeout)
 
-def function_namespace(f, args=None):
-    """
-    Attempts to returns unique namespace for function
-    """
-    m_args = _get_argspec(f).args
-    instance_token = None
+    def _memoize_set_many(self, mapping, timeout=DEFAULT_TIMEOUT,
+                          pickles=None):
+        """
+        Same as ``_memoize_set`` for several values, with one ``set_many``.
+        ``pickles`` maps the keys to the pickles of their values, if already
+        known.
+        """
+        self.set_many(self._memoize_chunk_many(mapping, pickles),
+                      timeout=timeout)
 
-    instance_self = getattr(f, '__self__', None)
+    async def _amemoize_set_many(self, mapping, timeout=DEFAULT_TIMEOUT,
+                                 pickles=None):
+        """
+        Same as ``_memoize_set_many``, using the async cache API.
+        """
+        await self.aset_many(self._memoize_chunk_many(mapping, pickles),
+                             timeout=timeout)
 
-    if instance_self and not inspect.isclass(instance_self):
-        instance_token = repr(f.__self__)
-    elif m_args and m_args[0] == 'self' and args:
-        instance_token = repr(args[0])
+    def _memoize_chunk_many(self, mapping, pickles=None):
+        if self.max_item_size is None:
+            return mapping
+        pickles = pickles or {}
+        chunked = {}
+        for cache_key, value in mapping.items():
+            chunked.update(self._memoize_chunks(cache_key, value,
+                                                pickles.get(cache_key))
+                           or {cache_key: value})
+        return chunked
 
-    module = f.__module__ or __name__
+    def _memoize_write_scope(self):
+        """
+        Returns the ``_ScopeCache`` buffering the writes of this memoizer, or
+        None if they are not deferred.
+        """
+        if self.write_buffer_size is None or self.lease_timeout:
+            return None
+        return self._memoize_scope()
 
-    if hasattr(f, '__qualname__'):
-        name = f.__qualname__
-    else:
-        klass = getattr(f, '__self__', None)
+    def _memoize_store(self, cache_key, value, timeout, soft=False,
+                       data=None):
+        """
+        Stores a memoized value now, or hands it to the request scope buffer
+        or to the write behind queue. ``soft`` tells whether the value has
+        its own expiry time, ``data`` is its pickle if already known.
+        """
+        write_scope = self._memoize_write_scope()
+        if write_scope is not None:
+            if self._memoize_defer(write_scope, cache_key, value, timeout,
+                                   soft=soft, data=data):
+                self._memoize_flush(write_scope)
+        elif self.write_behind is not None and not self.lease_timeout:
+            self.write_behind.submit(self, cache_key, value, timeout,
+                                     'soft' if soft else timeout, data=data)
+        else:
+            self._memoize_set(cache_key, value, timeout=timeout, data=data)
 
-        if klass and not inspect.isclass(klass):
-            klass = klass.__class__
+    async def _amemoize_store(self, cache_key, value, timeout, soft=False,
+                              data=None):
+        """
+        Same as ``_memoize_store``, using the async cache API.
+        """
+        write_scope = self._memoize_write_scope()
+        if write_scope is not None:
+            if self._memoize_defer(write_scope, cache_key, value, timeout,
+                                   soft=soft, data=data):
+                await self._amemoize_flush(write_scope)
+        elif self.write_behind is not None and not self.lease_timeout:
+            self.write_behind.submit(self, cache_key, value, timeout,
+                                     'soft' if soft else timeout, data=data)
+        else:
+            await self._amemoize_set(cache_key, value, timeout=timeout,
+                                     data=data)
 
-        if not klass:
-            klass = getattr(f, 'im_class', None)
+    def _memoize_store_many(self, mapping, timeouts, soft=False,
+                            pickles=None):
+        """
+        Same as ``_memoize_store`` for several values, stored with one
+        ``set_many`` per timeout when stored now. Soft expiry times, if any,
+        are kept per value, so those values are stored together.
+        """
+        pickles = pickles or {}
+        write_scope = self._memoize_write_scope()
+        if write_scope is not None:
+            full = False
+            for (cache_key, value), timeout in zip(mapping.items(), timeouts):
+                full = self._memoize_defer(
+                    write_scope, cache_key, value, timeout, soft=soft,
+                    data=pickles.get(cache_key)
+                ) or full
+            if full:
+                self._memoize_flush(write_scope)
+        elif self.write_behind is not None and not self.lease_timeout:
+            for (cache_key, value), timeout in zip(mapping.items(), timeouts):
+                self.write_behind.submit(self, cache_key, value, timeout,
+                                         'soft' if soft else timeout,
+                                         data=pickles.get(cache_key))
+        else:
+            batches = OrderedDict()
+            for (cache_key, value), timeout in zip(mapping.items(), timeouts):
+                batch, batch_timeouts = batches.setdefault(
+                    'soft' if soft else timeout, ({}, [])
+                )
+                batch[cache_key] = value
+                batch_timeouts.append(timeout)
+            for batch, batch_timeouts in batches.values():
+                self._memoize_set_many(
+                    batch, timeout=self._memoize_max_timeout(batch_timeouts),
+                    pickles=pickles
+                )
 
-        if not klass:
-            if m_args and args:
-                if m_args[0] == 'self':
-                    klass = args[0].__class__
-                elif m_args[0] == 'cls':
-                    klass = args[0]
+    def _memoize_defer(self, scope, cache_key, value, timeout, soft=False,
+                       data=None):
+        """
+        Buffers a value to store when ``scope`` exits. Values with a soft
+        expiry time share a bucket, stored with the longest of their
+        timeouts. Returns whether the buffer is full.
+        """
+        bucket = scope.pending.setdefault(
+            'soft' if soft else timeout, OrderedDict()
+        )
+        bucket[cache_key] = (value, timeout, data)
+        return sum(len(b) for b in scope.pending.values()) >= \
+            self.write_buffer_size
 
-        if klass:
-            name = klass.__name__ + '.' + f.__name__
-        else:
-            name = f.__name__
+    def _memoize_pending_batches(self, scope):
+        """
+        Empties the buffer of ``scope`` and returns its values as mappings to
+        store, each with its timeout and the pickles of its values.
+        """
+        pending, scope.pending = scope.pending, {}
+        return [
+            (dict((key, value) for key, (value, _, _) in bucket.items()),
+             self._memoize_max_timeout([t for _, t, _ in bucket.values()]),
+             dict((key, data) for key, (_, _, data) in bucket.items()))
+            for bucket in pending.values()
+        ]
 
-    ns = '.'.join((module, name))
+    def _memoize_flush(self, scope):
+        """
+        Stores the values buffered in ``scope``, with one ``set_many`` per
+        timeout bucket.
+        """
+        _run_steps(self._memoize_flush_steps(scope, self._memoize_set_many))
 
-    if instance_token:
-        ins = '.'.join((module, name, instance_token))
-    else:
-        ins = None
+    async def _amemoize_flush(self, scope):
+        """
+        Same as ``_memoize_flush``, using the async cache API.
+        """
+        await _arun_steps(self._memoize_flush_steps(scope,
+                                                    self._amemoize_set_many))
 
-    return ns, ins
+    def _memoize_flush_steps(self, scope, set_many):
+        for mapping, timeout, pickles in \
+                self._memoize_pending_batches(scope):
+            try:
+                yield functools.partial(set_many, mapping, timeout=timeout,
+                                        pickles=pickles)
+            except Exception:
+                if settings.DEBUG:
+                    raise
+                logger.exception("Exception possibly due to cache backend.")
 
+    def _memoize_scope(self):
+        """
+        Returns the ``_ScopeCache`` of this memoizer in the current request
+        scope, or None outside of one.
+        """
+        scope = _current_scope.get()
+        if scope is None:
+            return None
+        return scope.cache(self)
 
-class Memoizer(object):
-    """
-    This class is used to control the memoizer objects.
-    """
+    def _memoize_scope_clear(self):
+        """
+        Drops the values of the current request scope, after an invalidation.
+        With ``combined_lookup`` their keys do not depend on the versions.
+        """
+        scope = self._memoize_scope()
+        if scope is not None:
+            scope.values.clear()
 
-    def __init__(self, cache=default_cache, cache_prefix='memoize',
-                 default_cache_value=DEFAULT_CACHE_OBJECT):
-        self.cache = cache
-        self.cache_prefix = cache_prefix
-        self.default_cache_value = default_cache_value
+    def _memoize_local_timeout(self, timeout, local_timeout=None):
+        """
+        Returns for how long a value memoized with ``timeout`` may be kept in
+        the local cache, 0 if it should not be kept there.
+        """
+        if self.local_cache is None:
+            return 0
 
-    def get(self, key):
-        "Proxy function for internal cache object."
-        return self.cache.get(key=key, default=self.default_cache_value)
+        timeouts = [self.local_cache.timeout]
+        if local_timeout is not None:
+            timeouts.append(local_timeout)
+        if isinstance(timeout, (int, float)):
+            timeouts.append(timeout)
+        return max(min(timeouts), 0)
 
-    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
-        "Proxy function for internal cache object."
-        self.cache.set(key=key, value=value, timeout=timeout)
+    def _memoize_local_set(self, cache_key, value, local_timeout, plan,
+                           args=None):
+        """
+        Keeps ``value`` in the local cache, tagged with the namespaces of the
+        function so that ``delete_memoized`` can drop it.
+        """
+        if isinstance(value, _CachedException):
+            #: exceptions are only kept for their own timeout
+            return
+        fname, instance_fname = plan.namespace(args)
+        tags = [fname]
+        if instance_fname:
+            tags.append(instance_fname)
+        self.local_cache.set(cache_key, value, local_timeout, tags=tags)
 
-    def add(self, key, value, timeout=DEFAULT_TIMEOUT):
-        "Proxy function for internal cache object."
-        self.cache.add(key=key, value=value, timeout=timeout)
+    def _memoize_local_delete(self, f):
+        """
+        Drops from the local cache the values that a version reset of ``f``
+        invalidates.
+        """
+        if self.local_cache is not None:
+            fname, instance_fname = function_namespace(f)
+            self.local_cache.delete_tag(instance_fname or fname)
 
-    def delete(self, key):
-        "Proxy function for internal cache object."
-        self.cache.delete(key=key)
+    def _memoize_max_timeout(self, timeouts):
+        """
+        Returns the longest of ``timeouts``.
+        """
+        if None in timeouts:
+            return None
+        timeouts = [t for t in timeouts if t is not DEFAULT_TIMEOUT]
+        return max(timeouts) if timeouts else DEFAULT_TIMEOUT
 
-    def delete_many(self, *keys):
-        "Proxy function for internal cache object."
-        self.cache.delete_many(keys=keys)
+    def _memoize_soft_timeout(self, timeout, stale_ttl=None, jitter=None):
+        """
+        Returns the time after which a value memoized with ``timeout`` is
+        refreshed, and the timeout to store it with so that it can still be
+        served ``stale_ttl`` seconds longer.
 
-    def clear(self):
-        "Proxy function for internal cache object."
-        self.cache.clear()
+        With ``jitter``, ``timeout`` is shortened by a random fraction of at
+        most ``jitter``.
+        """
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.cache.default_timeout
+        if timeout is None or timeout <= 0:
+            return None, timeout
+        if jitter:
+            timeout -= timeout * jitter * random.random()
+        return time.time() + timeout, timeout + (stale_ttl or 0)
 
-    def get_many(self, *keys):
-        "Proxy function for internal cache object."
-        d = self.cache.get_many(keys=keys)
+    def _memoize_expired(self, value, beta=None):
+        """
+        Tells whether the ``_SoftValue`` ``value`` should be recomputed.
 
-        values = []
-        for key in keys:
-            values.append(
-                d.get(key)
-            )
+        With ``beta``, it may be recomputed before it expires, the sooner the
+        longer it took to compute and the larger ``beta`` is, so that values
+        stored at the same time do not all expire at once (XFetch).
+        """
+        now = time.time()
+        if beta and value.delta:
+            now -= value.delta * beta * math.log(1.0 - random.random())
+        return value.expires <= now
 
-        return values
+    def _memoize_lease(self, cache_key, compute, fetch, stale):
+        """
+        Returns ``compute``, guarded by a lease when ``lease_timeout`` is set.
+        """
+        if not self.lease_timeout:
+            return compute
+        return functools.partial(self._memoize_leased, cache_key, compute,
+                                 fetch, stale)
 
-    def set_many(self, mapping, timeout=DEFAULT_TIMEOUT):
-        "Proxy function for internal cache object."
-        self.cache.set_many(data=mapping, timeout=timeout)
+    def _memoize_leased(self, cache_key, compute, fetch, stale):
+        """
+        Runs ``compute`` for a missing ``cache_key`` if no other process is
+        computing it, as told by a lease key added to the cache backend.
 
-    def _memvname(self, funcname):
-        return hashlib.md5(
-            force_bytes(funcname)
-        ).hexdigest() + "_memver"
+        Otherwise returns ``stale`` if it is not the default cache value, or
+        polls the backend with ``fetch`` until the value shows up or the lease
+        expires, in which case the value is computed anyway.
+        """
+        return _run_steps(self._memoize_lease_steps(
+            cache_key, compute, fetch, stale, self.add, self.delete,
+            time.sleep
+        ))
 
-    def _memoize_make_version_hash(self):
-        return uuid.uuid4().hex
+    async def _amemoize_leased(self, cache_key, compute, fetch, stale):
+        """
+        Same as ``_memoize_leased`` for coroutine functions: ``compute`` and
+        ``fetch`` return awaitables.
+        """
+        return await _arun_steps(self._memoize_lease_steps(
+            cache_key, compute, fetch, stale, self.aadd, self.adelete,
+            asyncio.sleep
+        ))
 
-    def _memoize_version(self, f, args=None,
-                         reset=False, delete=False, timeout=DEFAULT_TIMEOUT):
+    def _memoize_lease_steps(self, cache_key, compute, fetch, stale, add,
+                             delete, sleep):
         """
-        Updates the hash version associated with a memoized function or method.
+        The steps of ``_memoize_leased``, run by ``_run_steps`` with the sync
+        cache API or by ``_arun_steps`` with the async one.
         """
-        fname, instance_fname = function_namespace(f, args=args)
-        version_key = self._memvname(fname)
-        fetch_keys = [version_key]
+        lease_key = cache_key + ':lease'
+        deadline = time.time() + self.lease_timeout
+        add = functools.partial(add, lease_key, 1, timeout=self.lease_timeout)
 
-        if instance_fname:
-            instance_version_key = self._memvname(instance_fname)
-            fetch_keys.append(instance_version_key)
+        while True:
+            try:
+                leased = yield add
+            except Exception:
+                if settings.DEBUG:
+                    raise
+                logger.exception("Exception possibly due to cache backend.")
+                return (yield compute)
 
-        # Only delete the per-instance version key or per-function version
-        # key but not both.
-        if delete:
-            self.delete(fetch_keys[-1])
-            return fname, None
+            if leased:
+                try:
+                    #: the value may have been stored since it was missed
+                    try:
+                        rv, _, _, expired = yield fetch
+                    except Exception:
+                        if settings.DEBUG:
+                            raise
+                        logger.exception(
+                            "Exception possibly due to cache backend."
+                        )
+                    else:
+                        if rv is not self.default_cache_value and not expired:
+                            return rv
+                    return (yield compute)
+                finally:
+                    try:
+                        yield functools.partial(delete, lease_key)
+                    except Exception:
+                        if settings.DEBUG:
+                            raise
+                        logger.exception(
+                            "Exception possibly due to cache backend."
+                        )
 
-        version_data_list = self.get_many(*fetch_keys)
-        dirty = False
+            if stale is not self.default_cache_value:
+                return stale
 
-        if version_data_list[0] is None:
-            version_data_list[0] = self._memoize_make_version_hash()
-            dirty = True
+            if time.time() >= deadline:
+                return (yield compute)
 
-        if instance_fname and version_data_list[1] is None:
-            version_data_list[1] = self._memoize_make_version_hash()
-            dirty = True
+            yield functools.partial(sleep, self.lease_poll_interval)
 
-        # Only reset the per-instance version or the per-function version
-        # but not both.
-        if reset:
-            fetch_keys = fetch_keys[-1:]
-            version_data_list = [self._memoize_make_version_hash()]
-            dirty = True
+            try:
+                rv = (yield fetch)[0]
+            except Exception:
+                if settings.DEBUG:
+                    raise
+                logger.exception("Exception possibly due to cache backend.")
+                return (yield compute)
 
-        if dirty:
-            self.set_many(
-                dict(zip(fetch_keys, version_data_list)), timeout=timeout
-            )
+            if rv is not self.default_cache_value:
+                return rv
+
+    def _memoize_compress(self, value, zdict=None, name=None, data=None):
+        """
+        Returns ``value``, or its pickle compressed with the preset dictionary
+        ``zdict`` if it is at least ``compress_threshold`` bytes and shrinks.
+        ``data`` is the pickle of ``value``, if already known.
+        """
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        if data is None:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) < self.compress_threshold:
+            return value
+
+        if zdict:
+            compressor = zlib.compressobj(self.compress_level, zdict=zdict)
+            compressed = compressor.compress(data) + compressor.flush()
+        else:
+            compressed = zlib.compress(data, self.compress_level)
 
-        return fname, ''.join(version_data_list)
+        if stats is not None:
+            stats.observe(name, 'compress_time', time.perf_counter() - start)
+            stats.observe(name, 'compression_ratio',
+                          float(len(compressed)) / len(data))
+        if len(compressed) >= len(data):
+            return value
+        return _CompressedValue(compressed,
+                                zlib.adler32(zdict) if zdict else 0)
 
-    def _memoize_make_cache_key(self, make_name=None, timeout=DEFAULT_TIMEOUT):
+    def _memoize_decompress(self, value, zdict=None, name=None):
+        """
+        Returns the value stored compressed as ``value``, or the default cache
+        value if it cannot be decompressed with ``zdict``.
+        """
+        if value.dict_id != (zlib.adler32(zdict) if zdict else 0):
+            return self.default_cache_value
+
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        try:
+            if zdict:
+                data = zlib.decompressobj(zdict=zdict).decompress(value.data)
+            else:
+                data = zlib.decompress(value.data)
+            value = pickle.loads(data)
+        except Exception:
+            logger.exception("Exception while decompressing a memoized value.")
+            return self.default_cache_value
+
+        if stats is not None:
+            stats.observe(name, 'decompress_time',
+                          time.perf_counter() - start)
+        return value
+
+    def _memoize_loads(self, data, serializer, name=None):
+        """
+        Returns the value serialized as ``data``, or the default cache value
+        if ``serializer`` cannot read it.
+        """
+        try:
+            return serializer.loads(data)
+        except Exception:
+            logger.exception("Exception while deserializing a memoized value.")
+            if self.stats is not None:
+                self.stats.incr(name, 'errors')
+            return self.default_cache_value
+
+    def _memoize_sampled(self):
+        """
+        Returns whether to trace a memoized call.
+        """
+        rate = self.trace_sample_rate
+        return rate >= 1 or random.random() < rate
+
+    def _memoize_make_cache_key(self, make_name=None, timeout=DEFAULT_TIMEOUT,
+                                plan=None):
         """
         Function used to create the cache_key for memoized functions.
+
+        If ``plan`` is given, calls for its function skip the introspection of
+        the function's signature and namespace.
         """
         def make_cache_key(f, *args, **kwargs):
             _timeout = getattr(timeout, 'cache_timeout', timeout)
-            fname, version_data = self._memoize_version(f, args=args,
-                                                        timeout=_timeout)
+            stale_ttl = getattr(timeout, 'stale_ttl', None)
+            if stale_ttl:
+                #: the version has to outlive the values served stale
+                _timeout = self._memoize_soft_timeout(_timeout, stale_ttl)[1]
+
+            if plan is not None and f is plan.f:
+                _plan = plan
+            elif callable(f):
+                _plan = self._memoize_key_plan(f)
+            else:
+                _plan = None
+
+            if self.combined_lookup:
+                #: the version is stored along with the value instead
+                if _plan is not None:
+                    fname = _plan.namespace(args)[0]
+                else:
+                    fname = function_namespace(f, args=args)[0]
+                version_data = ''
+            else:
+                fname, version_data = self._memoize_version(f, args=args,
+                                                            timeout=_timeout,
+                                                            plan=_plan)
 
             #: this should have to be after version_data, so that it
             #: does not break the delete_memoized functionality.
@@ -207,16 +3836,17 @@ class Memoizer(object):
             else:
                 altfname = fname
 
-            if callable(f):
-                keyargs, keykwargs = self._memoize_kwargs_to_args(
-                    f, *args, **kwargs
-                )
+            if _plan is not None:
+                keyargs, keykwargs = _plan.bind(args, kwargs)
             else:
                 keyargs, keykwargs = args, kwargs
 
-            cache_key = hashlib.md5(
-                force_bytes((altfname, keyargs, keykwargs))
-            ).hexdigest()
+            if self.key_hasher is not None:
+                cache_key = self.key_hasher(altfname, keyargs, keykwargs)
+            else:
+                cache_key = hashlib.md5(
+                    force_bytes((altfname, keyargs, keykwargs))
+                ).hexdigest()
             cache_key += version_data
 
             if self.cache_prefix:
@@ -230,64 +3860,13 @@ class Memoizer(object):
         #: This allows the memoization to be the same
         #: whether the function was called with
         #: 1, b=2 is equivilant to a=1, b=2, etc.
-        new_args = []
-        arg_num = 0
-        argspec = _get_argspec(f)
-
-        args_len = len(argspec.args)
-        for i in range(args_len):
-            if i == 0 and argspec.args[i] in ('self', 'cls'):
-                #: use the repr of the class instance
-                #: this supports instance methods for
-                #: the memoized functions, giving more
-                #: flexibility to developers
-                arg = repr(args[0])
-                arg_num += 1
-            elif argspec.args[i] in kwargs:
-                arg = kwargs.pop(argspec.args[i])
-            elif arg_num < len(args):
-                arg = args[arg_num]
-                arg_num += 1
-            elif abs(i - args_len) <= len(argspec.defaults):
-                arg = argspec.defaults[i - args_len]
-                arg_num += 1
-            else:
-                arg = None
-                arg_num += 1
+        return _KeyPlan(f).bind(args, kwargs)
 
-            #: Attempt to convert all arguments to a
-            #: hash/id or a representation?
-            #: Not sure if this is necessary, since
-            #: using objects as keys gets tricky quickly.
-            # if hasattr(arg, '__class__'):
-            #     try:
-            #         arg = hash(arg)
-            #     except:
-            #         arg = repr(arg)
-
-            #: Or what about a special __cacherepr__ function
-            #: on an object, this allows objects to act normal
-            #: upon inspection, yet they can define a representation
-            #: that can be used to make the object unique in the
-            #: cache key. Given that a case comes across that
-            #: an object "must" be used as a cache key
-            # if hasattr(arg, '__cacherepr__'):
-            #     arg = arg.__cacherepr__
-
-            new_args.append(arg)
-
-        # If there are any missing varargs then
-        # just append them since consistency of the key trumps order.
-        if argspec.varargs and args_len < len(args):
-            new_args.extend(args[args_len:])
-
-        return tuple(new_args), kwargs
-
-    def memoize(self, 
-            timeout=DEFAULT_TIMEOUT, 
-            make_name=None, 
-            unless=None, 
-            min_time=0):
+    def memoize(self, timeout=DEFAULT_TIMEOUT, make_name=None, unless=None,
+                min_time=0, local_timeout=None, stale_ttl=None,
+                early_recompute=None, ttl_jitter=None, ignore=None,
+                key_args=None, compress_dict=None, serializer=None,
+                cache_exceptions=(), exception_ttl=None):
         """
         Use this to cache the result of a function, taking its arguments into
         account in the cache key.
@@ -312,7 +3891,7 @@ class Memoizer(object):
 
         .. note::
 
-            The returned decorated function now has three function attributes
+            The returned decorated function now has these function attributes
             assigned to it.
 
                 **uncached**
@@ -330,6 +3909,16 @@ class Memoizer(object):
 
                     readable and writable
 
+                **many**
+                    ``many(args_list, workers=None)`` returns the values for
+                    each item of ``args_list``, a tuple of positional
+                    arguments or a single argument, with one ``get_many`` for
+                    the versions, one for the values and one ``set_many`` for
+                    the misses. The misses are computed on ``workers``
+                    threads if set.
+
+                    readable only
+
 
         :param timeout: Default: 300. If set to an integer, will cache
                         for that amount of time. Unit of time is in seconds.
@@ -340,53 +3929,76 @@ class Memoizer(object):
         :param unless: Default: None. Cache will *always* execute the caching
                        facilities unless this callable is true.
                        This will bypass the caching entirely.
+        :param local_timeout: Default: None. If set, caps the time the values
+                              of this function are kept in the memoizer's
+                              local cache. 0 keeps them out of it.
+        :param stale_ttl: Default: None. If set, values are kept that many
+                          seconds past ``timeout``. During that time they are
+                          still returned, and refreshed in the background.
+        :param early_recompute: Default: None. If set, values may be
+                                recomputed before ``timeout``, with a
+                                probability growing as it nears and with the
+                                time the function took. 1.0 is a good start;
+                                larger values recompute earlier.
+        :param ttl_jitter: Default: None. If set, ``timeout`` is shortened by a
+                           random fraction of at most ``ttl_jitter`` for each
+                           stored value, e.g. 0.1 for up to 10%.
+        :param ignore: Default: None. If set, names of the arguments left out
+                       of the cache key, e.g. a request or a logger.
+        :param key_args: Default: None. If set, names of the only arguments
+                         used in the cache key. Mutually exclusive with
+                         ``ignore``.
+        :param compress_dict: Default: None. If set, bytes used as preset
+                              dictionary to compress the values of this
+                              function, e.g. a typical pickled value. Values
+                              compressed with another dictionary are misses.
+        :param serializer: Default: None. If set, overrides the memoizer's
+                           ``serializer`` for this function.
+        :param cache_exceptions: Default: (). Exception classes, as in an
+                                 ``except`` clause, that are memoized in
+                                 place of a value and raised again on a hit.
+        :param exception_ttl: Default: None. If set, the timeout of memoized
+                              exceptions, otherwise ``timeout``. They are not
+                              kept in the local cache.
         """
 
         def memoize(f):
-            @functools.wraps(f)
-            def decorated_function(*args, **kwargs):
-                #: bypass cache
-                if callable(unless) and unless() is True:
-                    return f(*args, **kwargs)
+            memoized = _MemoizedFunction(
+                self, f, unless=unless, min_time=min_time,
+                local_timeout=local_timeout, stale_ttl=stale_ttl,
+                early_recompute=early_recompute, ttl_jitter=ttl_jitter,
+                ignore=ignore, key_args=key_args, compress_dict=compress_dict,
+                serializer=serializer, cache_exceptions=cache_exceptions,
+                exception_ttl=exception_ttl
+            )
 
-                # try to fetch the function's return value from the cache
-                try:
-                    cache_key = decorated_function.make_cache_key(
-                        f, *args, **kwargs
-                    )
-                    rv = self.get(cache_key)
-                except Exception:
-                    if settings.DEBUG:
-                        raise
-                    logger.exception(
-                        "Exception possibly due to cache backend."
+            if inspect.iscoroutinefunction(f):
+                if not hasattr(self.cache, 'aget') and sync_to_async is None:
+                    raise ImproperlyConfigured(
+                        "Memoizing coroutine functions needs the async cache "
+                        "API of Django 4.0+, or asgiref."
                     )
-                    return f(*args, **kwargs)
-
-                # if a cache miss occurs, run the function from scratch
-                # and cache the resulting return value
-                if rv == self.default_cache_value:
-                    start_time = time.time()
-                    rv = f(*args, **kwargs)
-                    elapsed_time = time.time() - start_time
-                    try:
-                        if elapsed_time > min_time:
-                            self.set(
-                                cache_key, rv,
-                                timeout=decorated_function.cache_timeout
-                            )
-                    except Exception:
-                        if settings.DEBUG:
-                            raise
-                        logger.exception(
-                            "Exception possibly due to cache backend."
-                        )
-                return rv
 
+                @functools.wraps(f)
+                async def async_decorated_function(*args, **kwargs):
+                    return await memoized.acall(args, kwargs)
+
+                decorated_function = async_decorated_function
+            else:
+                @functools.wraps(f)
+                def sync_decorated_function(*args, **kwargs):
+                    return memoized(args, kwargs)
+
+                sync_decorated_function.many = memoized.many
+                decorated_function = sync_decorated_function
+
+            memoized.wrapper = decorated_function
             decorated_function.uncached = f
             decorated_function.cache_timeout = timeout
+            decorated_function.stale_ttl = stale_ttl
+            decorated_function.skip_instance = memoized.plan.skip_instance
             decorated_function.make_cache_key = self._memoize_make_cache_key(
-                make_name, decorated_function
+                make_name, decorated_function, plan=memoized.plan
             )
             decorated_function.delete_memoized = (
                 lambda: self.delete_memoized(f)
@@ -511,10 +4123,25 @@ class Memoizer(object):
 
         try:
             if not args and not kwargs:
+                if getattr(f, 'skip_instance', False):
+                    #: the values are shared by all instances, and so is
+                    #: their version
+                    f = getattr(f, '__func__', f)
                 self._memoize_version(f, reset=True)
+                self._memoize_local_delete(f)
+                self._memoize_scope_clear()
             else:
                 cache_key = f.make_cache_key(f.uncached, *args, **kwargs)
+                if self.write_behind is not None:
+                    self.write_behind.discard(self, cache_key)
                 self.delete(cache_key)
+                if self.local_cache is not None:
+                    self.local_cache.delete(cache_key)
+                scope = self._memoize_scope()
+                if scope is not None:
+                    scope.values.pop(cache_key, None)
+                    for bucket in scope.pending.values():
+                        bucket.pop(cache_key, None)
         except Exception:
             if settings.DEBUG:
                 raise
@@ -540,6 +4167,8 @@ class Memoizer(object):
 
         try:
             self._memoize_version(f, delete=True)
+            self._memoize_local_delete(f)
+            self._memoize_scope_clear()
         except Exception:
             if settings.DEBUG:
                 raise
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import os
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+
+
+class LockedFileBasedCache(FileBasedCache):
+    """
+    File based cache whose ``add`` is atomic across processes, standing in
+    for a shared cache backend such as memcached in tests.
+    """
+
+    def __init__(self, dir, params):
+        super(LockedFileBasedCache, self).__init__(dir, params)
+        if not os.path.exists(self._dir):
+            os.makedirs(self._dir)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with open(os.path.join(self._dir, 'add.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return super(LockedFileBasedCache, self).add(
+                key, value, timeout=timeout, version=version
+            )
@@ -0,0 +1,6 @@
+from django.db import models
+
+
+class Person(models.Model):
+    name = models.CharField(max_length=100)
+    age = models.IntegerField(default=0)
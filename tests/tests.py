@@ -1,18 +1,46 @@
 # -*- coding: utf-8 -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import asyncio
 import datetime
+import functools
+import gc
+import inspect
 import random
 import sys
+import threading
 import time
+import traceback
 import logging
-
+import unittest
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import weakref
+
+import django
+from django.core.cache import cache as default_cache
 from django.test import SimpleTestCase
 
 from freezegun import freeze_time
-from memoize import Memoizer, _get_argspec, function_namespace
+from memoize import (
+    InMemoryTracer, LazyResult, Memoizer, MemoizeStats, PickleSerializer,
+    PrometheusExporter, SignalExporter, _ChunkedValue, _CompressedValue,
+    WriteBehind, _get_argspec, batch_scope, function_namespace,
+    key_fragment, request_scope, stats_exported
+)
+from memoize.middleware import RequestScopeMiddleware
 from mock import MagicMock, patch
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .cache import LockedFileBasedCache
+
 
 class MemoizeTestCase(SimpleTestCase):
     def setUp(self):
@@ -753,4 +781,1775 @@ class MemoizeTestCase(SimpleTestCase):
         assert (
             result_slow_1 == result_slow_2,
             "Slow function should cache results"
-        )
\ No newline at end of file
+        )
+
+    def test_28_memoize_key_plan_matches_introspection(self):
+        class Adder(object):
+            def __repr__(self):
+                return 'Adder()'
+
+            @self.memoizer.memoize()
+            def add(self, a, b=2, *args, **kwargs):
+                return a + b + random.random()
+
+        adder = Adder()
+        make_cache_key = self.memoizer._memoize_make_cache_key(
+            None, Adder.add
+        )
+
+        for args, kwargs in [((1,), {}), ((1, 3, 4), {'c': 5}),
+                             ((), {'a': 1, 'b': 3})]:
+            assert (
+                Adder.add.make_cache_key(Adder.add.uncached, adder,
+                                         *args, **kwargs) ==
+                make_cache_key(Adder.add.uncached, adder, *args, **kwargs)
+            )
+
+        plan = self.memoizer._memoize_key_plan(Adder.add.uncached)
+        assert plan.namespace((adder,)) == function_namespace(
+            Adder.add.uncached, (adder,))
+
+    def test_29_memoize_hit_does_not_introspect(self):
+        @self.memoizer.memoize()
+        def f(a, b=1):
+            return a + b + random.random()
+
+        result = f(1)
+
+        with patch('memoize._get_argspec') as get_argspec:
+            assert f(1) == result
+            assert f(a=1, b=1) == result
+            assert get_argspec.call_count == 0
+
+    def test_30_memoize_version_cache(self):
+        memoizer = Memoizer(version_cache_timeout=10)
+
+        @memoizer.memoize()
+        def f(a):
+            return a + random.random()
+
+        result = f(1)
+        misses = memoizer.version_cache.misses
+
+        with patch.object(memoizer, 'get_many',
+                          wraps=memoizer.get_many) as get_many:
+            assert f(1) == result
+            assert f(1) == result
+            assert get_many.call_count == 0
+
+        assert memoizer.version_cache.hits >= 2
+        assert memoizer.version_cache.misses == misses
+
+        # Invalidations made by this process are seen immediately.
+        memoizer.delete_memoized(f)
+        assert f(1) != result
+
+    def test_31_memoize_version_cache_timeout(self):
+        memoizer = Memoizer(version_cache_timeout=10)
+        other = Memoizer()
+
+        @memoizer.memoize()
+        def f():
+            return random.random()
+
+        result = f()
+
+        # Invalidation from another process, seen once the local copy of the
+        # version expires.
+        other.delete_memoized(f)
+        assert f() == result
+
+        now = datetime.datetime.utcfromtimestamp(time.time())
+        with freeze_time(now) as frozen_datetime:
+            frozen_datetime.tick(delta=datetime.timedelta(seconds=11))
+            assert f() != result
+
+    def test_32_memoize_combined_lookup(self):
+        memoizer = Memoizer(combined_lookup=True)
+
+        @memoizer.memoize()
+        def f(a):
+            return a + random.random()
+
+        result = f(1)
+        result2 = f(2)
+
+        with patch.object(memoizer, 'get_many',
+                          wraps=memoizer.get_many) as get_many, \
+                patch.object(memoizer, 'get') as get:
+            assert f(1) == result
+            assert get_many.call_count == 1
+            assert get.call_count == 0
+
+        memoizer.delete_memoized(f, 2)
+        assert f(1) == result
+        assert f(2) != result2
+
+        # The value key does not change with the version, the stored version
+        # makes the old value stale.
+        cache_key = f.make_cache_key(f.uncached, 1)
+        memoizer.delete_memoized(f)
+        assert f.make_cache_key(f.uncached, 1) == cache_key
+        assert f(1) != result
+
+    def test_33_memoize_combined_lookup_with_version_cache(self):
+        memoizer = Memoizer(combined_lookup=True, version_cache_timeout=10)
+
+        class Adder(object):
+            def __init__(self, initial):
+                self.initial = initial
+
+            def __repr__(self):
+                return 'Adder(%s)' % self.initial
+
+            @memoizer.memoize()
+            def add(self, b):
+                return self.initial + b + random.random()
+
+        adder1 = Adder(1)
+        adder2 = Adder(2)
+        a1 = adder1.add(3)
+        a2 = adder2.add(3)
+
+        with patch.object(memoizer, 'get_many',
+                          wraps=memoizer.get_many) as get_many:
+            assert adder1.add(3) == a1
+            get_many.assert_called_once_with(
+                adder1.add.make_cache_key(Adder.add.uncached, adder1, 3)
+            )
+
+        memoizer.delete_memoized(adder1.add)
+        assert adder1.add(3) != a1
+        assert adder2.add(3) == a2
+
+    def test_34_memoize_local_cache(self):
+        memoizer = Memoizer(local_cache_timeout=10)
+
+        class Adder(object):
+            def __init__(self, initial):
+                self.initial = initial
+
+            def __repr__(self):
+                return 'Adder(%s)' % self.initial
+
+            @memoizer.memoize()
+            def add(self, b):
+                return self.initial + b + random.random()
+
+        adder1 = Adder(1)
+        adder2 = Adder(2)
+        a1 = adder1.add(3)
+        a2 = adder2.add(3)
+
+        with patch.object(memoizer, 'get') as get:
+            assert adder1.add(3) == a1
+            assert adder2.add(3) == a2
+            assert get.call_count == 0
+        assert memoizer.local_cache.hits == 2
+
+        # Values fetched from the backend are kept locally as well.
+        memoizer.local_cache.clear()
+        assert adder1.add(3) == a1
+        with patch.object(memoizer, 'get') as get:
+            assert adder1.add(3) == a1
+            assert get.call_count == 0
+
+        memoizer.delete_memoized(adder1.add)
+        assert adder1.add(3) != a1
+        assert adder2.add(3) == a2
+
+        memoizer.delete_memoized(Adder.add)
+        assert adder2.add(3) != a2
+
+    def test_35_memoize_local_cache_timeout(self):
+        memoizer = Memoizer(local_cache_timeout=10)
+
+        @memoizer.memoize(local_timeout=5)
+        def f():
+            return random.random()
+
+        @memoizer.memoize(local_timeout=0)
+        def g():
+            return random.random()
+
+        f()
+        g()
+        assert len(memoizer.local_cache._values) == 1
+
+        now = datetime.datetime.utcfromtimestamp(time.time())
+        with freeze_time(now) as frozen_datetime:
+            frozen_datetime.tick(delta=datetime.timedelta(seconds=6))
+            with patch.object(memoizer, 'get',
+                              wraps=memoizer.get) as get:
+                f()
+                assert get.call_count == 1
+
+    def test_36_local_cache_bounds(self):
+        from memoize import LocalCache
+
+        local_cache = LocalCache(10, max_entries=2)
+        local_cache.set('a', 1, 10)
+        local_cache.set('b', 2, 10)
+        assert local_cache.get('a') == 1
+        local_cache.set('c', 3, 10)
+        assert local_cache.get('b') is None
+        assert local_cache.get('a') == 1
+        assert local_cache.get('c') == 3
+
+        local_cache = LocalCache(10, max_bytes=200)
+        local_cache.set('a', 'x' * 120, 10)
+        local_cache.set('b', 'y' * 80, 10)
+        assert local_cache.get('a') is None
+        assert local_cache.get('b') == 'y' * 80
+        local_cache.set('c', 'z' * 500, 10)
+        assert local_cache.get('c') is None
+        assert local_cache.size <= 200
+
+    def test_37_memoize_single_flight(self):
+        memoizer = Memoizer(single_flight_timeout=5)
+        calls = []
+
+        @memoizer.memoize()
+        def f(a):
+            calls.append(a)
+            time.sleep(0.2)
+            return a + random.random()
+
+        # Create the version of the function beforehand, otherwise each thread
+        # may create its own.
+        f(0)
+        del calls[:]
+
+        barrier = threading.Barrier(5)
+        results = []
+
+        def call():
+            barrier.wait()
+            results.append(f(1))
+
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1
+        assert len(set(results)) == 1
+        assert memoizer.single_flight.coalesced == 4
+        assert memoizer.single_flight._flights == {}
+
+    def test_38_single_flight_timeout_and_failure(self):
+        from memoize import SingleFlight
+
+        single_flight = SingleFlight(0.05)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait()
+            raise ValueError()
+
+        def leader():
+            try:
+                single_flight.run('key', slow)
+            except ValueError:
+                pass
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait()
+
+        # The computation in flight takes too long.
+        assert single_flight.run('key', lambda: 1) == 1
+        assert single_flight.timeouts == 1
+
+        # The computation in flight fails.
+        single_flight.timeout = 5
+        waiter_results = []
+        waiter = threading.Thread(
+            target=lambda: waiter_results.append(
+                single_flight.run('key', lambda: 2)
+            )
+        )
+        waiter.start()
+        time.sleep(0.05)
+        release.set()
+        thread.join()
+        waiter.join()
+
+        assert waiter_results == [2]
+        assert single_flight.failures == 1
+        assert single_flight.coalesced == 0
+
+    def test_39_memoize_lease(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        calls_file = os.path.join(cache_dir, 'calls')
+
+        memoizer = Memoizer(cache=LockedFileBasedCache(cache_dir, {}),
+                            lease_timeout=5, lease_poll_interval=0.01)
+
+        @memoizer.memoize()
+        def f(a):
+            with open(calls_file, 'a') as calls:
+                calls.write('%s\n' % a)
+            time.sleep(0.3)
+            return a + random.random()
+
+        # Create the version of the function beforehand, otherwise each
+        # process may create its own.
+        f(0)
+        os.remove(calls_file)
+
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(4)
+        results = context.Queue()
+
+        def call():
+            barrier.wait()
+            results.put(f(1))
+
+        processes = [context.Process(target=call) for _ in range(4)]
+        for process in processes:
+            process.start()
+        values = [results.get(timeout=10) for _ in processes]
+        for process in processes:
+            process.join()
+
+        with open(calls_file) as calls:
+            assert calls.read() == '1\n'
+        assert len(set(values)) == 1
+        assert memoizer.get(f.make_cache_key(f.uncached, 1) + ':lease') is \
+            memoizer.default_cache_value
+
+    def test_40_memoize_lease_serves_stale_value(self):
+        memoizer = Memoizer(combined_lookup=True, lease_timeout=5)
+
+        @memoizer.memoize()
+        def f():
+            return random.random()
+
+        result = f()
+        memoizer.delete_memoized(f)
+
+        # Another process holds the lease, the outdated value is served.
+        lease_key = f.make_cache_key(f.uncached) + ':lease'
+        memoizer.add(lease_key, 1)
+        assert f() == result
+
+        memoizer.delete(lease_key)
+        assert f() != result
+
+    def test_41_memoize_lease_expires(self):
+        memoizer = Memoizer(lease_timeout=0.1, lease_poll_interval=0.01)
+
+        @memoizer.memoize()
+        def f():
+            return random.random()
+
+        lease_key = f.make_cache_key(f.uncached) + ':lease'
+        memoizer.add(lease_key, 1, timeout=60)
+
+        with patch('memoize.time.sleep') as sleep:
+            result = f()
+            assert sleep.call_count >= 1
+        assert f() == result
+
+    def test_42_memoize_stale_ttl(self):
+        memoizer = Memoizer()
+        calls = []
+
+        @memoizer.memoize(timeout=10, stale_ttl=20)
+        def f(a):
+            calls.append(a)
+            return a + random.random()
+
+        # The clock has to move for values to be stored, see min_time.
+        now = datetime.datetime.utcfromtimestamp(time.time())
+        with freeze_time(now, auto_tick_seconds=0.001) as frozen_datetime:
+            result = f(1)
+
+            frozen_datetime.tick(delta=datetime.timedelta(seconds=11))
+            assert f(1) == result
+            memoizer.refresher.wait()
+
+            assert len(calls) == 2
+            assert memoizer.refresher.scheduled == 1
+            refreshed = f(1)
+            assert refreshed != result
+
+            # Past the stale time the value is computed again inline.
+            frozen_datetime.tick(delta=datetime.timedelta(seconds=31))
+            assert f(1) != refreshed
+            assert len(calls) == 3
+
+    def test_43_background_refresher(self):
+        from memoize import BackgroundRefresher
+
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        refresher = BackgroundRefresher(max_workers=1, max_pending=2)
+        release = threading.Event()
+        done = []
+
+        def refresh(name):
+            release.wait()
+            done.append(name)
+
+        def fail():
+            raise ValueError()
+
+        assert refresher.submit('a', functools.partial(refresh, 'a'))
+        assert not refresher.submit('a', functools.partial(refresh, 'a2'))
+        assert refresher.submit('b', fail)
+        assert not refresher.submit('c', functools.partial(refresh, 'c'))
+        assert refresher.scheduled == 2
+        assert refresher.skipped == 2
+
+        release.set()
+        refresher.wait()
+        assert done == ['a']
+        assert refresher.submit('c', functools.partial(refresh, 'c'))
+        refresher.wait()
+        assert done == ['a', 'c']
+
+    def test_44_memoize_early_recompute(self):
+        memoizer = Memoizer()
+        calls = []
+
+        @memoizer.memoize(timeout=10, early_recompute=10000)
+        def f():
+            calls.append(1)
+            time.sleep(0.01)
+            return len(calls)
+
+        assert f() == 1
+
+        # Far from the expiry time for this function.
+        with patch('memoize.random.random', return_value=0.0):
+            assert f() == 1
+
+        # Close enough given how long the function takes.
+        with patch('memoize.random.random', return_value=0.5):
+            assert f() == 2
+        with patch('memoize.random.random', return_value=0.0):
+            assert f() == 2
+
+    def test_45_memoize_ttl_jitter(self):
+        memoizer = Memoizer()
+
+        @memoizer.memoize(timeout=100, ttl_jitter=0.2)
+        def f():
+            return random.random()
+
+        with patch.object(memoizer, 'set') as memoizer_set, \
+                patch('memoize.random.random', return_value=0.5):
+            f()
+
+        value = memoizer_set.call_args[0][1]
+        assert memoizer_set.call_args[1]['timeout'] == 90
+        assert 89 < value.expires - time.time() <= 90
+
+    def test_46_memoize_many(self):
+        memoizer = Memoizer()
+        calls = []
+
+        @memoizer.memoize()
+        def f(a, b=1):
+            calls.append(a)
+            return a + b + random.random()
+
+        result1 = f(1)
+        result3 = f(3, 2)
+        del calls[:]
+
+        with patch.object(memoizer, 'get_many',
+                          wraps=memoizer.get_many) as get_many, \
+                patch.object(memoizer, 'set_many',
+                             wraps=memoizer.set_many) as set_many:
+            results = f.many([1, 2, (3, 2), 2])
+            assert get_many.call_count == 2
+            assert set_many.call_count == 1
+
+        assert results[0] == result1
+        assert results[2] == result3
+        assert results[1] == results[3]
+        assert calls == [2]
+
+        assert f(2) == results[1]
+        assert f.many([]) == []
+
+        memoizer.delete_memoized(f)
+        assert f.many([1])[0] != result1
+
+    def test_47_memoize_many_methods(self):
+        memoizer = Memoizer(combined_lookup=True)
+
+        class Adder(object):
+            def __init__(self, initial):
+                self.initial = initial
+
+            def __repr__(self):
+                return 'Adder(%s)' % self.initial
+
+            @memoizer.memoize()
+            def add(self, b):
+                return self.initial + b + random.random()
+
+        adder1 = Adder(1)
+        adder2 = Adder(2)
+        a1 = adder1.add(3)
+
+        results = Adder.add.many([(adder1, 3), (adder2, 3)], workers=2)
+        assert results[0] == a1
+        assert adder2.add(3) == results[1]
+
+        memoizer.delete_memoized(adder1.add)
+        results2 = Adder.add.many([(adder1, 3), (adder2, 3)])
+        assert results2[0] != a1
+        assert results2[1] == results[1]
+
+    def test_48_memoize_many_version_cache(self):
+        memoizer = Memoizer(version_cache_timeout=10, local_cache_timeout=10)
+
+        @memoizer.memoize()
+        def f(a):
+            return a + random.random()
+
+        results = f.many(range(3))
+
+        with patch.object(memoizer, 'get_many') as get_many:
+            assert f.many(range(3)) == results
+            assert get_many.call_count == 0
+
+    @unittest.skipIf(django.VERSION < (4, 0), 'needs the async cache API')
+    def test_49_memoize_coroutine_function(self):
+        memoizer = Memoizer()
+        calls = []
+
+        @memoizer.memoize()
+        async def f(a):
+            calls.append(a)
+            await asyncio.sleep(0.01)
+            return a + random.random()
+
+        assert inspect.iscoroutinefunction(f)
+
+        async def main():
+            # Create the version of the function beforehand, otherwise each
+            # task may create its own.
+            await f(0)
+            del calls[:]
+
+            results = await asyncio.gather(*[f(1) for _ in range(5)])
+            assert len(set(results)) == 1
+            assert await f(1) == results[0]
+            assert calls == [1]
+            assert memoizer.async_flights.coalesced == 4
+            return results[0]
+
+        with patch.object(memoizer, 'get') as get, \
+                patch.object(memoizer, 'get_many') as get_many:
+            result = asyncio.run(main())
+            assert get.call_count == 0
+            assert get_many.call_count == 0
+
+        memoizer.delete_memoized(f, 1)
+        assert asyncio.run(f(1)) != result
+        assert not hasattr(f, 'many')
+
+    @unittest.skipIf(django.VERSION < (4, 0), 'needs the async cache API')
+    def test_50_memoize_coroutine_function_combined_lookup(self):
+        memoizer = Memoizer(combined_lookup=True, version_cache_timeout=10)
+
+        class Adder(object):
+            def __init__(self, initial):
+                self.initial = initial
+
+            def __repr__(self):
+                return 'Adder(%s)' % self.initial
+
+            @memoizer.memoize()
+            async def add(self, b):
+                return self.initial + b + random.random()
+
+        adder1 = Adder(1)
+        adder2 = Adder(2)
+
+        async def main():
+            a1 = await adder1.add(3)
+            a2 = await adder2.add(3)
+
+            with patch.object(memoizer, 'aget_many',
+                              wraps=memoizer.aget_many) as aget_many:
+                assert await adder1.add(3) == a1
+                assert aget_many.call_count == 1
+
+            memoizer.delete_memoized(adder1.add)
+            assert await adder1.add(3) != a1
+            assert await adder2.add(3) == a2
+
+        asyncio.run(main())
+
+    @unittest.skipIf(django.VERSION < (4, 0), 'needs the async cache API')
+    def test_51_memoize_coroutine_function_stale_ttl(self):
+        memoizer = Memoizer()
+        calls = []
+
+        @memoizer.memoize(timeout=10, stale_ttl=20)
+        async def f():
+            calls.append(1)
+            return len(calls)
+
+        async def main():
+            assert await f() == 1
+
+            real_time = time.time
+            with patch('memoize.time.time',
+                       side_effect=lambda: real_time() + 11):
+                assert await f() == 1
+                flights = memoizer.async_flights._flights[
+                    asyncio.get_event_loop()
+                ]
+                await asyncio.gather(*flights.values())
+            assert calls == [1, 1]
+            assert await f() == 2
+
+        asyncio.run(main())
+
+    def test_52_canonical_key_hasher(self):
+        from memoize import CanonicalKeyHasher
+
+        hasher = CanonicalKeyHasher()
+
+        key = hasher('f', (1, 'a'), {'x': 1, 'y': [1, 2]})
+        assert len(key) == 32
+        assert key == hasher('f', [1, 'a'], {'y': [1, 2], 'x': 1})
+        assert hasher('f', ({'a': 1, 'b': 2},), {}) == \
+            hasher('f', ({'b': 2, 'a': 1},), {})
+        assert hasher('f', ({1, 2, 3},), {}) == hasher('f', ({3, 1, 2},), {})
+
+        distinct = [
+            (1,), (1.0,), ('1',), (b'1',), (True,), (None,), ((1,),),
+            ([1],), ({1},), ('a', 'b'), ('ab',), ({'a': 1},),
+        ]
+        keys = set(hasher('f', args, {}) for args in distinct)
+        assert len(keys) == len(distinct)
+        assert hasher('f', (1,), {}) != hasher('g', (1,), {})
+
+        assert len(CanonicalKeyHasher(digest_size=8)('f', (), {})) == 16
+
+    def test_53_memoize_key_hasher(self):
+        from memoize import CanonicalKeyHasher
+
+        memoizer = Memoizer(key_hasher=CanonicalKeyHasher(digest_size=10))
+
+        @memoizer.memoize()
+        def f(a, b=None):
+            return random.random()
+
+        result = f(1, b={'x': 1, 'y': 2})
+        assert f(1, {'y': 2, 'x': 1}) == result
+        assert f(1) != result
+
+        cache_key = f.make_cache_key(f.uncached, 1)
+        assert len(cache_key.split(':')[1]) == 20 + 32
+
+        memoizer.delete_memoized(f, 1, {'x': 1, 'y': 2})
+        assert f(1, b={'x': 1, 'y': 2}) != result
+
+    def test_54_memoize_cache_key_protocol(self):
+        class Service(object):
+            def __init__(self, id):
+                self.id = id
+                self.reprs = 0
+
+            def __repr__(self):
+                self.reprs += 1
+                return 'Service(%s)' % self.id
+
+            def __cache_key__(self):
+                return self.id
+
+            @self.memoizer.memoize()
+            def compute(self, other, extra=None):
+                return random.random()
+
+        service1 = Service(1)
+        service2 = Service(2)
+
+        result = service1.compute(service2)
+        assert service1.compute(Service(2)) == result
+        assert service1.compute(service2, extra=Service(2)) != result
+        assert Service(1).compute(Service(2)) == result
+        assert service1.reprs == 0
+        assert service2.reprs == 0
+
+        assert function_namespace(Service.compute, (service1,)) == \
+            function_namespace(Service.compute, (Service(1),))
+
+        # The type is part of the fragment.
+        @self.memoizer.memoize()
+        def f(a):
+            return random.random()
+
+        assert f(Service(1)) != f(1)
+
+        self.memoizer.delete_memoized(service1.compute)
+        assert service1.compute(service2) != result
+
+    def test_55_register_cache_key(self):
+        from memoize import key_fragment, register_cache_key
+
+        class Point(object):
+            def __init__(self, x, y):
+                self.x = x
+                self.y = y
+
+        class Point3D(Point):
+            pass
+
+        register_cache_key(Point, lambda point: (point.x, point.y))
+
+        assert key_fragment(Point(1, 2))[1] == (1, 2)
+        assert key_fragment(Point3D(1, 2))[1] == (1, 2)
+        assert key_fragment(Point(1, 2)) != key_fragment(Point3D(1, 2))
+        assert key_fragment(1) == 1
+
+        @self.memoizer.memoize()
+        def f(point):
+            return random.random()
+
+        assert f(Point(1, 2)) == f(Point(1, 2))
+        assert f(Point(1, 2)) != f(Point(2, 1))
+
+    def test_56_memoize_model_instances(self):
+        from .models import Person
+
+        @self.memoizer.memoize()
+        def f(person):
+            return random.random()
+
+        with patch.object(Person, '__repr__') as person_repr:
+            result = f(Person(pk=1, name='a'))
+            assert f(Person(pk=1, name='b')) == result
+            assert f(Person(pk=2, name='a')) != result
+            assert person_repr.call_count == 0
+
+        other = Person(pk=1, name='a')
+        other._state.db = 'other'
+        assert f(other) != result
+
+        assert key_fragment(Person(pk=1))[1] == ('tests', 'person', None, 1)
+        assert key_fragment(other)[1] == ('tests', 'person', 'other', 1)
+
+    def test_57_memoize_querysets(self):
+        from .models import Person
+
+        @self.memoizer.memoize()
+        def f(queryset):
+            return random.random()
+
+        # SimpleTestCase fails on database queries.
+        result = f(Person.objects.filter(age__gt=30))
+        assert f(Person.objects.filter(age__gt=30)) == result
+        assert f(Person.objects.filter(age__gt=40)) != result
+        assert f(Person.objects.filter(age__gt=30).values_list('id')) != \
+            f(Person.objects.filter(age__gt=30).values_list('id', flat=True))
+        assert f(Person.objects.filter(
+            pk__in=[])) == f(Person.objects.filter(pk__in=[]))
+
+    def test_58_memoize_buffers(self):
+        @self.memoizer.memoize()
+        def f(data):
+            return random.random()
+
+        data = b'x' * 100000
+        other = b'x' * 50000 + b'y' + b'x' * 49999
+
+        result = f(data)
+        assert f(bytes(data)) == result
+        assert f(other) != result
+        assert f(bytearray(data)) == f(bytearray(data))
+        assert f(memoryview(data)) == f(memoryview(bytearray(data)))
+        assert f(memoryview(data)[::2]) == f(memoryview(data[::2]))
+        assert f(memoryview(data)) != f(memoryview(other))
+
+        fragment = key_fragment(data)[1]
+        assert fragment[0] == 100000
+        assert len(fragment[1]) == 32
+        assert key_fragment(b'small') == b'small'
+
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_59_memoize_arrays(self):
+        @self.memoizer.memoize()
+        def f(array):
+            return random.random()
+
+        array = numpy.zeros((1000, 1000))
+        other = array.copy()
+        other[500, 500] = 1
+
+        result = f(array)
+        assert f(array.copy()) == result
+        assert f(other) != result
+        assert f(array.astype(numpy.float32)) != result
+        assert f(array.reshape((100, 10000))) != result
+        assert f(array.T[::2]) == f(numpy.ascontiguousarray(array.T[::2]))
+        assert f(numpy.array([[1], 'a'], dtype=object)) == \
+            f(numpy.array([[1], 'a'], dtype=object))
+
+        dates = numpy.array(['2020-01-01', '2020-01-02'],
+                            dtype='datetime64[D]')
+        result = f(dates)
+        assert f(dates.copy()) == result
+        assert f(dates + 1) != result
+        assert f(dates.astype('datetime64[s]')) != result
+        assert f(dates[::-1]) != result
+        assert f(numpy.diff(dates)) == f(numpy.array([1], 'timedelta64[D]'))
+
+    def test_60_memoize_ignore(self):
+        @self.memoizer.memoize(ignore=['request', 'kwargs'])
+        def f(a, request=None, *args, **kwargs):
+            return random.random()
+
+        result = f(1, 'request1')
+        assert f(1, 'request2') == result
+        assert f(1, request='request3', log=True) == result
+        assert f(1, None, 2) != result
+        assert f(2, 'request1') != result
+
+        class Request(object):
+            def __repr__(self):
+                raise AssertionError('repr of an ignored argument')
+
+        assert f(1, Request()) == result
+
+        self.memoizer.delete_memoized(f, 1, 'request4')
+        assert f(1, 'request1') != result
+
+        @self.memoizer.memoize(ignore=['args'])
+        def g(a, *args):
+            return random.random()
+
+        assert g(1, 2) == g(1, 3)
+
+        with self.assertRaises(ValueError):
+            self.memoizer.memoize(ignore=['b'])(lambda a: a)
+
+    def test_61_memoize_key_args(self):
+        class Adder(object):
+            def __init__(self, initial):
+                self.initial = initial
+
+            def __repr__(self):
+                return 'Adder(%s)' % self.initial
+
+            @self.memoizer.memoize(key_args=['b'])
+            def add(self, b, connection=None, logger=None):
+                return self.initial + b + random.random()
+
+        adder1 = Adder(1)
+        result = adder1.add(1, 'default', 'logger')
+        assert adder1.add(1, 'replica') == result
+        assert adder1.add(2, 'default') != result
+        assert Adder(2).add(1, 'default') != result
+
+        with self.assertRaises(ValueError):
+            self.memoizer.memoize(key_args=['c'])(lambda a: a)
+        with self.assertRaises(ValueError):
+            self.memoizer.memoize(ignore=['a'], key_args=['a'])(lambda a: a)
+
+    def test_62_memoize_stats(self):
+        exporter = PrometheusExporter()
+        received = []
+
+        def receiver(sender, stats, **kwargs):
+            received.append(stats)
+
+        stats_exported.connect(receiver)
+        self.addCleanup(stats_exported.disconnect, receiver)
+        stats = MemoizeStats(exporters=[exporter, SignalExporter()])
+        memoizer = Memoizer(stats=stats)
+
+        @memoizer.memoize()
+        def f(a):
+            return 'x' * a
+
+        f(10)
+        f(10)
+        f(20)
+        f.many([10, 30])
+
+        name = function_namespace(f.uncached)[0]
+        data = stats.snapshot()[name]
+        assert data['hits'] == 2
+        assert data['misses'] == 3
+        assert data['errors'] == 0
+        assert data['key_time']['count'] == 3
+        assert data['compute_time']['count'] == 3
+        assert data['size']['count'] == 3
+        assert data['size']['buckets'][0] == (256, 3)
+
+        with patch.object(memoizer, 'get', side_effect=ValueError):
+            assert f(10) == 'x' * 10
+        assert stats.snapshot()[name]['errors'] == 1
+
+        stats.export()
+        assert received[0][name]['hits'] == 2
+        assert ('memoize_hits_total{function="%s"} 2' % name) \
+            in exporter.text
+        assert ('memoize_value_bytes_bucket{function="%s",le="+Inf"} 3'
+                % name) in exporter.text
+
+        stats.reset()
+        assert stats.snapshot() == {}
+        assert Memoizer().stats is None
+
+    def test_63_memoize_tracing(self):
+        tracer = InMemoryTracer()
+        memoizer = Memoizer(tracer=tracer)
+
+        @memoizer.memoize()
+        def f(a):
+            return 'x' * a
+
+        f(10)
+        root = tracer.spans[-1]
+        assert root.name == 'memoize'
+        assert root.parent is None
+        assert root.attributes['memoize.function'] == \
+            function_namespace(f.uncached)[0]
+        assert root.attributes['memoize.hit'] is False
+        assert root.attributes['memoize.size'] > 10
+        assert [span.name for span in tracer.children(root)] == [
+            'memoize.version', 'memoize.key', 'memoize.get',
+            'memoize.compute', 'memoize.set'
+        ]
+
+        tracer.clear()
+        f(10)
+        root = tracer.spans[-1]
+        assert root.attributes['memoize.hit'] is True
+        assert [span.name for span in tracer.children(root)] == [
+            'memoize.version', 'memoize.key', 'memoize.get'
+        ]
+
+        tracer.clear()
+        memoizer.trace_sample_rate = 0
+        f(10)
+        assert tracer.spans == []
+
+    @unittest.skipIf(django.VERSION < (4, 0), 'needs the async cache API')
+    def test_64_memoize_tracing_coroutine(self):
+        tracer = InMemoryTracer()
+        memoizer = Memoizer(tracer=tracer, combined_lookup=True)
+
+        @memoizer.memoize()
+        async def f(a):
+            return a
+
+        assert asyncio.run(f(1)) == 1
+        root = [span for span in tracer.spans if span.name == 'memoize'][0]
+        assert root.attributes['memoize.hit'] is False
+        assert [span.name for span in tracer.children(root)] == [
+            'memoize.key', 'memoize.get', 'memoize.compute', 'memoize.set'
+        ]
+
+    def test_65_memoize_compression(self):
+        stats = MemoizeStats()
+        memoizer = Memoizer(compress_threshold=100, stats=stats)
+
+        @memoizer.memoize()
+        def f(a):
+            return [a] * a
+
+        result = f(1000)
+        cache_key = f.make_cache_key(f.uncached, 1000)
+        stored = memoizer.get(cache_key)
+        assert isinstance(stored, _CompressedValue)
+        assert len(stored.data) < 100
+        assert f(1000) == result
+
+        assert f(1) == [1]
+        assert memoizer.get(f.make_cache_key(f.uncached, 1)) == [1]
+
+        data = stats.snapshot()[function_namespace(f.uncached)[0]]
+        assert data['compression_ratio']['count'] == 1
+        assert data['compression_ratio']['sum'] < 0.1
+        assert data['decompress_time']['count'] == 1
+        assert data['size']['sum'] < 300
+
+    def test_66_memoize_compression_dict(self):
+        memoizer = Memoizer(compress_threshold=10)
+        zdict = b'{"name": "", "email": "@example.com", "active": true}'
+
+        @memoizer.memoize(compress_dict=zdict)
+        def f(name):
+            return '{"name": "%s", "email": "%s@example.com", ' \
+                '"active": true}' % (name, name)
+
+        result = f('bob')
+        stored = memoizer.get(f.make_cache_key(f.uncached, 'bob'))
+        assert isinstance(stored, _CompressedValue)
+        assert f('bob') == result
+
+        assert memoizer._memoize_decompress(stored, zdict) == result
+        assert memoizer._memoize_decompress(stored, b'another dictionary') \
+            is memoizer.default_cache_value
+
+    def test_67_pickle_serializer(self):
+        serializer = PickleSerializer()
+
+        assert serializer.dumps(b'abc') == pickle.dumps(b'abc', 5)
+        for value in (b'abc', u'\xe9t\xe9', u'\ud800', {'a': [1, 2.5, None]}):
+            assert serializer.loads(serializer.dumps(value)) == value
+
+        with self.assertRaises(ValueError):
+            serializer.loads(b'Xabc')
+
+        memoizer = Memoizer(serializer=serializer)
+
+        @memoizer.memoize()
+        def f(a):
+            return {'a': a, 'r': random.random()}
+
+        result = f(1)
+        stored = memoizer.get(f.make_cache_key(f.uncached, 1))
+        assert isinstance(stored, bytes)
+        assert f(1) == result
+
+        memoizer.set(f.make_cache_key(f.uncached, 2), b'corrupted')
+        assert f(2)['a'] == 2
+
+        @memoizer.memoize(serializer=PickleSerializer(protocol=1))
+        def g(a):
+            return [a]
+
+        assert g(1) == [1]
+        assert g(1) == [1]
+        assert memoizer.get(g.make_cache_key(g.uncached, 1))[:1] == b'P'
+
+        @memoizer.memoize()
+        def h(a):
+            return a + u'\ud800'
+
+        assert h(u'a') == u'a\ud800'
+        with self.settings(DEBUG=True):
+            assert h(u'a') == u'a\ud800'
+        assert memoizer.get(h.make_cache_key(h.uncached, u'a')) == \
+            pickle.dumps(u'a\ud800', 5)
+
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    @unittest.skipIf(sys.version_info < (3, 8), 'needs pickle protocol 5')
+    def test_68_pickle_serializer_buffers(self):
+        serializer = PickleSerializer()
+        array = numpy.arange(100000, dtype='float64')
+
+        data = serializer.dumps(array)
+        assert data[:1] == b'O'
+        assert len(data) < array.nbytes + 1024
+
+        result = serializer.loads(data)
+        assert (result == array).all()
+        assert not result.flags.writeable
+
+        with self.assertRaises(ValueError):
+            serializer.loads(data[:-1])
+
+    def test_69_memoize_chunked_values(self):
+        memoizer = Memoizer(max_item_size=1000)
+
+        @memoizer.memoize()
+        def f(a):
+            return [random.random() for _ in range(a)]
+
+        result = f(500)
+        cache_key = f.make_cache_key(f.uncached, 500)
+        manifest = memoizer.get(cache_key)
+        assert isinstance(manifest, _ChunkedValue)
+        chunk_keys = memoizer._memoize_chunk_keys(cache_key, manifest)
+        assert len(chunk_keys) == manifest.count > 1
+        assert all(len(chunk) <= 1000
+                   for chunk in memoizer.get_many(*chunk_keys))
+        assert f(500) == result
+
+        assert f(10) == f(10)
+        assert not isinstance(memoizer.get(f.make_cache_key(f.uncached, 10)),
+                              _ChunkedValue)
+
+        #: a partially evicted value is a miss
+        memoizer.delete(chunk_keys[-1])
+        result = f(500)
+        assert f(500) == result
+
+        #: as is a corrupted one
+        cache_key = f.make_cache_key(f.uncached, 500)
+        chunk_keys = memoizer._memoize_chunk_keys(cache_key,
+                                                  memoizer.get(cache_key))
+        chunk = memoizer.get(chunk_keys[0])
+        memoizer.set(chunk_keys[0],
+                     chunk[:-1] + bytes([chunk[-1] ^ 1]))
+        assert f(500) != result
+
+        assert f.many([500, 600]) == [f(500), f(600)]
+
+    def test_70_memoize_chunked_values_combined_lookup(self):
+        memoizer = Memoizer(max_item_size=1000, combined_lookup=True)
+
+        @memoizer.memoize()
+        def f(a):
+            return [random.random() for _ in range(a)]
+
+        result = f(500)
+        assert isinstance(
+            memoizer.get(f.make_cache_key(f.uncached, 500)), _ChunkedValue
+        )
+        assert f(500) == result
+        assert f.many([500, 10]) == [result, f(10)]
+
+        memoizer.delete_memoized(f)
+        assert f(500) != result
+
+    def test_71_request_scope(self):
+        stats = MemoizeStats()
+        memoizer = Memoizer(stats=stats)
+
+        @memoizer.memoize()
+        def f(a):
+            return random.random()
+
+        with request_scope():
+            result = f(1)
+            with patch.object(memoizer, 'get_many') as get_many, \
+                    patch.object(memoizer, 'get') as get:
+                assert f(1) == result
+                assert f.many([1]) == [result]
+            assert not get_many.called
+            assert not get.called
+
+            memoizer.delete_memoized(f)
+            assert f(1) != result
+
+        name = function_namespace(f.uncached)[0]
+        assert stats.snapshot()[name]['scope_hits'] == 2
+
+        #: each thread has its own scope
+        seen = []
+
+        def run():
+            with request_scope():
+                with patch.object(memoizer, 'get_many',
+                                  wraps=memoizer.get_many) as get_many:
+                    f(2)
+                    seen.append(get_many.called)
+
+        with request_scope():
+            f(2)
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+        assert seen == [True]
+
+    def test_72_request_scope_middleware(self):
+        memoizer = Memoizer()
+
+        @memoizer.memoize()
+        def f(a):
+            return random.random()
+
+        def view(request):
+            return [f(1), f(1), memoizer._memoize_scope() is not None]
+
+        response = RequestScopeMiddleware(view)(None)
+        assert response[0] == response[1]
+        assert response[2]
+        assert memoizer._memoize_scope() is None
+
+    @unittest.skipIf(django.VERSION < (4, 0), 'needs the async cache API')
+    def test_73_request_scope_coroutine(self):
+        memoizer = Memoizer()
+
+        @memoizer.memoize()
+        async def f(a):
+            return random.random()
+
+        async def view(request):
+            result = await f(1)
+            with patch.object(memoizer, 'aget_many') as aget_many, \
+                    patch.object(memoizer, 'aget') as aget:
+                assert await f(1) == result
+            assert not aget_many.called
+            assert not aget.called
+            return result
+
+        middleware = RequestScopeMiddleware(view)
+        assert inspect.iscoroutinefunction(middleware) or \
+            asyncio.iscoroutinefunction(middleware)
+        asyncio.run(middleware(None))
+
+    def test_74_deferred_writes(self):
+        memoizer = Memoizer(write_buffer_size=10)
+
+        @memoizer.memoize(timeout=100)
+        def f(a):
+            return random.random()
+
+        @memoizer.memoize(timeout=200)
+        def g(a):
+            return random.random()
+
+        with patch.object(memoizer, 'set_many',
+                          wraps=memoizer.set_many) as set_many:
+            with request_scope():
+                f(0)
+                g(0)
+                set_many.reset_mock()
+                with patch.object(memoizer, 'set') as set_:
+                    results = [f(1), f(2), g(1)]
+                    assert [f(1), f(2), g(1)] == results
+                    assert f.many([1, 3])[0] == results[0]
+                assert not set_.called
+                assert not set_many.called
+                cache_key = f.make_cache_key(f.uncached, 1)
+                assert memoizer.get(cache_key) is \
+                    memoizer.default_cache_value
+
+            timeouts = sorted(c[1]['timeout'] for c in set_many.call_args_list)
+            assert timeouts == [100, 200]
+
+        assert memoizer.get(cache_key) == results[0]
+        assert [f(1), f(2), g(1)] == results
+
+    def test_75_deferred_writes_buffer_size(self):
+        memoizer = Memoizer(write_buffer_size=2)
+
+        @memoizer.memoize()
+        def f(a):
+            return random.random()
+
+        with request_scope():
+            f(0)
+            result = f(1)
+            assert memoizer.get(f.make_cache_key(f.uncached, 1)) == result
+            result = f(2)
+            memoizer.delete_memoized(f, 2)
+        assert f(2) != result
+
+    @unittest.skipIf(django.VERSION < (4, 0), 'needs the async cache API')
+    def test_76_deferred_writes_coroutine(self):
+        memoizer = Memoizer(write_buffer_size=10)
+
+        @memoizer.memoize()
+        async def f(a):
+            return random.random()
+
+        async def main():
+            await f(0)
+            async with request_scope():
+                result = await f(1)
+                assert await memoizer.aget(
+                    f.make_cache_key(f.uncached, 1)
+                ) is memoizer.default_cache_value
+            assert await memoizer.aget(
+                f.make_cache_key(f.uncached, 1)
+            ) == result
+
+        asyncio.run(main())
+
+    def test_77_write_behind(self):
+        memoizer = Memoizer(write_behind=WriteBehind(batch_size=2))
+
+        @memoizer.memoize(timeout=100)
+        def f(a):
+            return random.random()
+
+        with patch.object(memoizer, 'set_many',
+                          wraps=memoizer.set_many) as set_many:
+            with patch.object(memoizer, 'set') as set_:
+                results = [f(1), f(2), f(3)]
+                assert memoizer.write_behind.flush(5)
+            assert not set_.called
+            assert set_many.call_count >= 2
+
+        assert [f(1), f(2), f(3)] == results
+        write_behind = memoizer.write_behind
+        assert (write_behind.queued, write_behind.written,
+                write_behind.dropped) == (3, 3, 0)
+        results = f.many([4, 5])
+        assert write_behind.flush(5)
+        assert [f(4), f(5)] == results
+
+    def test_78_write_behind_policy(self):
+        write_behind = WriteBehind(max_queue=1)
+        memoizer = Memoizer(write_behind=write_behind)
+        event = threading.Event()
+
+        def set_many(*args, **kwargs):
+            event.wait(5)
+            return []
+
+        with patch.object(memoizer, 'set_many', side_effect=set_many):
+            assert write_behind.submit(memoizer, 'a', 1, 100, 100)
+            while write_behind._queue:
+                time.sleep(0.01)
+            assert write_behind.submit(memoizer, 'b', 2, 100, 100)
+            assert not write_behind.submit(memoizer, 'c', 3, 100, 100)
+            event.set()
+            assert write_behind.flush(5)
+        assert (write_behind.queued, write_behind.written,
+                write_behind.dropped) == (2, 2, 1)
+
+        write_behind = WriteBehind(max_queue=1, policy='drop_oldest')
+        with patch.object(write_behind, '_run'):
+            write_behind.submit(memoizer, 'a', 1, 100, 100)
+            write_behind.submit(memoizer, 'b', 2, 100, 100)
+        assert [e[1] for e in write_behind._queue] == ['b']
+        assert write_behind.dropped == 1
+
+        with self.assertRaises(ValueError):
+            WriteBehind(policy='unknown')
+
+    def test_79_write_behind_fork(self):
+        write_behind = WriteBehind()
+        memoizer = Memoizer(write_behind=write_behind)
+        with patch.object(write_behind, '_run'):
+            write_behind.submit(memoizer, 'a', 1, 100, 100)
+            thread = write_behind._thread
+            with patch('os.getpid', return_value=-1):
+                write_behind.submit(memoizer, 'b', 2, 100, 100)
+        assert write_behind._thread is not thread
+        assert [e[1] for e in write_behind._queue] == ['b']
+
+    def count_get_many(self):
+        get_many = Memoizer.get_many
+        fetches = []
+
+        def counting_get_many(memoizer, *keys, **kwargs):
+            fetches.append(keys)
+            return get_many(memoizer, *keys, **kwargs)
+
+        return fetches, patch.object(Memoizer, 'get_many', counting_get_many)
+
+    def test_80_batch_scope(self):
+        memoizer = Memoizer()
+        other = Memoizer(cache_prefix='other')
+
+        @memoizer.memoize()
+        def f(a):
+            return random.random()
+
+        @other.memoize()
+        def g(a):
+            return random.random()
+
+        @memoizer.memoize()
+        def h(a):
+            return f(a) + 1
+
+        @memoizer.memoize()
+        def fail(a):
+            raise ValueError(a)
+
+        fetches, counting = self.count_get_many()
+        with counting, batch_scope() as batch:
+            with patch.object(Memoizer, 'get') as get:
+                results = [f(1), f(2), g(1)]
+                assert all(isinstance(result, LazyResult) and
+                           not result.resolved for result in results)
+                #: the versions, then the values of the three calls
+                values = [result.get() for result in results]
+                assert len(fetches) == 2
+                assert len(fetches[1]) == 3
+
+                del fetches[:]
+                again = [f(1), f(2), g(1)]
+                batch.tick()
+                assert all(result.resolved for result in again)
+                assert [result.get() for result in again] == values
+                assert len(fetches) == 2
+            assert not get.called
+
+            #: functions run on a miss get values
+            assert h(1).get() == values[0] + 1
+            error = fail(1)
+            last = f(2)
+
+        assert last.resolved and last.get() == values[1]
+        with self.assertRaises(ValueError):
+            error.get()
+        assert [f(1), f(2), g(1)] == values
+
+    def test_81_batch_scope_combined_lookup(self):
+        memoizer = Memoizer(combined_lookup=True)
+
+        @memoizer.memoize()
+        def f(a):
+            return random.random()
+
+        @memoizer.memoize()
+        def g(a):
+            return random.random()
+
+        fetches, counting = self.count_get_many()
+        with counting, request_scope():
+            with batch_scope():
+                results = [f(1), g(1), g(2)]
+            #: the versions and the values in one request
+            assert len(fetches) == 1
+            values = [result.get() for result in results]
+
+            with batch_scope():
+                again = [f(1), g(1), g(2)]
+            assert [result.get() for result in again] == values
+            assert len(fetches) == 1
+
+        assert [f(1), g(1), g(2)] == values
+
+    def test_82_cache_exceptions(self):
+        memoizer = Memoizer()
+        calls = []
+
+        @memoizer.memoize(cache_exceptions=(LookupError,), exception_ttl=10)
+        def f(a):
+            calls.append(a)
+            if a < 0:
+                raise KeyError(a)
+            if a == 0:
+                raise ValueError(a)
+            return None
+
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                f(-1)
+            with self.assertRaises(ValueError):
+                f(0)
+            assert f(1) is None
+        assert calls == [-1, 0, 1, 0]
+
+        #: None values are hits in many() too
+        del calls[:]
+        assert f.many([1, 2]) == [None, None]
+        assert f.many([1, 2]) == [None, None]
+        with self.assertRaises(KeyError):
+            f.many([2, -1])
+        with batch_scope():
+            result = f(-1)
+        with self.assertRaises(KeyError):
+            result.get()
+        assert calls == [2]
+
+        now = datetime.datetime.utcfromtimestamp(time.time())
+        with freeze_time(now) as frozen_datetime:
+            frozen_datetime.tick(delta=datetime.timedelta(seconds=11))
+            with self.assertRaises(KeyError):
+                f(-1)
+            assert f(1) is None
+        assert calls == [2, -1]
+
+        memoizer.set('none', None)
+        assert memoizer.get_many('none', 'missing') == [None, None]
+        assert memoizer.get_many(
+            'none', 'missing', default=memoizer.default_cache_value
+        ) == [None, memoizer.default_cache_value]
+
+    def test_83_batch_scope_repeated_calls(self):
+        memoizer = Memoizer()
+        calls = []
+
+        @memoizer.memoize()
+        def f(a):
+            calls.append(a)
+            return random.random()
+
+        fetches, counting = self.count_get_many()
+        with counting:
+            with batch_scope():
+                results = [f(1), f(1), f(2)]
+            #: the version hash once, then the two values
+            assert [len(keys) for keys in fetches] == [1, 2]
+        assert calls == [1, 2]
+        assert results[0].get() == results[1].get() == f(1)
+
+    def test_84_write_behind_invalidation(self):
+        write_behind = WriteBehind(block_timeout=0.1)
+        memoizer = Memoizer(write_behind=write_behind)
+        event = threading.Event()
+        set_many = memoizer.set_many
+
+        def slow_set_many(*args, **kwargs):
+            #: only the writes of the queue are held back
+            if threading.current_thread().name == 'memoize-write-behind':
+                event.wait(5)
+            return set_many(*args, **kwargs)
+
+        @memoizer.memoize()
+        def f(a):
+            return random.random()
+
+        with patch.object(memoizer, 'set_many', side_effect=slow_set_many):
+            f(0)
+            while write_behind._queue:
+                time.sleep(0.01)
+            results = [f(1), f(2)]
+            memoizer.delete_memoized(f, 1)
+            assert [e[1] for e in write_behind._queue] == [
+                f.make_cache_key(f.uncached, 2)
+            ]
+            event.set()
+            memoizer.delete_memoized(f, 2)
+            assert not write_behind._queue
+            assert write_behind.flush(5)
+
+        assert f(1) != results[0]
+        assert f(2) != results[1]
+        assert write_behind.dropped == 2
+
+        with patch.object(write_behind, '_run'):
+            f(3)
+            memoizer.clear()
+        assert not write_behind._queue
+
+    @unittest.skipIf(django.VERSION < (3, 0), 'needs asgiref')
+    def test_85_memoize_coroutine_function_sync_cache(self):
+        class SyncCache(object):
+            """A cache backend without the async API of Django 4.0+."""
+
+            def __getattr__(self, name):
+                if name.startswith('a') and name != 'add':
+                    raise AttributeError(name)
+                return getattr(default_cache, name)
+
+        memoizer = Memoizer(cache=SyncCache(), lease_timeout=1)
+
+        @memoizer.memoize()
+        async def f(a):
+            return a + random.random()
+
+        with self.settings(DEBUG=True):
+            result = asyncio.run(f(1))
+            assert asyncio.run(f(1)) == result
+        assert memoizer.get(f.make_cache_key(f.uncached, 1)) == result
+
+    def test_86_memoize_ignore_self(self):
+        class Service(object):
+            def __init__(self, name):
+                self.name = name
+
+            def __repr__(self):
+                raise AssertionError('repr of an ignored instance')
+
+            @self.memoizer.memoize(ignore=['self'])
+            def g(self, a):
+                return a + random.random()
+
+        result = Service(1).g(1)
+        assert Service(2).g(1) == result
+        assert Service(2).g(a=1) == result
+        assert Service(1).g(2) != result
+
+        self.memoizer.delete_memoized(Service(2).g)
+        assert Service(1).g(1) != result
+
+    def test_87_memoize_many_stale_ttl_single_flight(self):
+        memoizer = Memoizer(single_flight_timeout=5)
+        calls = []
+        flights = []
+
+        @memoizer.memoize(timeout=10, stale_ttl=20)
+        def f(a):
+            calls.append(a)
+            return a + random.random()
+
+        run = memoizer.single_flight.run
+
+        def spy(key, compute):
+            flights.append(key)
+            return run(key, compute)
+
+        memoizer.single_flight.run = spy
+
+        # The clock has to move for values to be stored, see min_time.
+        now = datetime.datetime.utcfromtimestamp(time.time())
+        with freeze_time(now, auto_tick_seconds=0.001) as frozen_datetime:
+            results = f.many([1, 2])
+            assert len(flights) == 2
+            assert f.many([1, 2]) == results
+
+            frozen_datetime.tick(delta=datetime.timedelta(seconds=11))
+            assert f.many([1, 2, 3])[:2] == results
+            memoizer.refresher.wait()
+
+            assert sorted(calls) == [1, 1, 2, 2, 3]
+            assert memoizer.refresher.scheduled == 2
+            refreshed = f.many([1, 2])
+            assert refreshed[0] != results[0]
+            assert refreshed[1] != results[1]
+            assert len(calls) == 5
+
+    def test_88_canonical_key_hasher_plain_containers(self):
+        from memoize import CanonicalKeyHasher
+
+        hasher = CanonicalKeyHasher()
+
+        large = dict(('key%d' % i, [i, str(i)]) for i in range(100))
+        assert hasher('f', (large,), {}) == \
+            hasher('f', (dict(reversed(list(large.items()))),), {})
+
+        # Large enough to be pickled at once.
+        filler = dict(('key%d' % i, i) for i in range(10))
+        items = [
+            [1, '1'], ['1', 1], [1.0], [1], [True], [None], ['None'],
+            ["a', 'b"], ['a', 'b'], [[1], [2]], [(1,), (2,)], [[1], 2],
+            [[1, 2]], [('a', 1)],
+        ]
+        values = [1, '1', [1], (1,), None, {'b': 1}]
+        distinct = [(item * 10,) for item in items]
+        distinct.extend((tuple(item * 10),) for item in items)
+        distinct.extend((dict(filler, a=value),) for value in values)
+        keys = set(hasher('f', args, {}) for args in distinct)
+        assert len(keys) == len(distinct)
+
+        # Equal values give the same key whether or not they share objects.
+        shared = 'a' * 10
+        copied = ''.join(['a'] * 10)
+        assert hasher('f', (shared, shared), {'x': [shared] * 10}) == \
+            hasher('f', (shared, copied), {'x': [copied] + [shared] * 9})
+
+    def test_89_memoize_pickles_values_once(self):
+        dumped = []
+
+        class Pickle(object):
+            HIGHEST_PROTOCOL = pickle.HIGHEST_PROTOCOL
+            loads = staticmethod(pickle.loads)
+
+            def dumps(self, obj, *args, **kwargs):
+                dumped.append(obj)
+                return pickle.dumps(obj, *args, **kwargs)
+
+        memoizer = Memoizer(compress_threshold=10 ** 6,
+                            max_item_size=10 ** 6, stats=MemoizeStats())
+
+        @memoizer.memoize()
+        def f(a):
+            return [a] * 1000
+
+        with patch('memoize.pickle', Pickle()):
+            assert f(1) == [1] * 1000
+            assert len(dumped) == 1
+            assert f.many([2, 3]) == [[2] * 1000, [3] * 1000]
+            assert len(dumped) == 3
+
+        data = memoizer.stats.snapshot()[function_namespace(f.uncached)[0]]
+        assert data['size']['count'] == 3
+
+    def test_90_cache_exceptions_scope(self):
+        memoizer = Memoizer()
+        calls = []
+
+        @memoizer.memoize(cache_exceptions=(LookupError,))
+        def f(a):
+            calls.append(a)
+            raise KeyError(a)
+
+        depths = []
+        with self.settings(DEBUG=True), request_scope():
+            for _ in range(3):
+                try:
+                    f(1)
+                except KeyError as e:
+                    depths.append(len(traceback.extract_tb(e.__traceback__)))
+        assert calls == [1]
+        assert depths[1] == depths[2]
+
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_91_memoize_numpy_result(self):
+        calls = []
+
+        for memoizer in [
+            Memoizer(cache_prefix='numpy1'),
+            Memoizer(cache_prefix='numpy2', serializer=PickleSerializer(),
+                     local_cache_timeout=10, combined_lookup=True),
+            Memoizer(cache_prefix='numpy3', lease_timeout=1,
+                     single_flight_timeout=1),
+        ]:
+            @memoizer.memoize(stale_ttl=10)
+            def f(n):
+                calls.append(n)
+                return numpy.arange(n)
+
+            del calls[:]
+            numpy.testing.assert_array_equal(f(10), numpy.arange(10))
+            numpy.testing.assert_array_equal(f(10), numpy.arange(10))
+            for result in f.many([10, 20]):
+                assert isinstance(result, numpy.ndarray)
+            with request_scope():
+                numpy.testing.assert_array_equal(f(20), numpy.arange(20))
+                numpy.testing.assert_array_equal(f(20), numpy.arange(20))
+            assert calls == [10, 20]
+
+            with batch_scope():
+                result = f(30)
+            numpy.testing.assert_array_equal(result.get(), numpy.arange(30))
+
+        @Memoizer().memoize()
+        async def g(n):
+            return numpy.arange(n)
+
+        for _ in range(2):
+            numpy.testing.assert_array_equal(asyncio.run(g(10)),
+                                             numpy.arange(10))
+
+    def test_92_memoize_lease_sync_and_async(self):
+        memoizer = Memoizer(lease_timeout=0.1, lease_poll_interval=0.01)
+
+        @memoizer.memoize()
+        def f(fail):
+            if fail:
+                raise ValueError
+            return random.random()
+
+        @memoizer.memoize()
+        async def g(fail):
+            if fail:
+                raise ValueError
+            return random.random()
+
+        def call(function, fail):
+            result = function(fail)
+            if inspect.isawaitable(result):
+                result = asyncio.run(result)
+            return result
+
+        for function in [f, g]:
+            # The lease is released when the function raises.
+            lease_key = function.make_cache_key(function.uncached,
+                                                True) + ':lease'
+            with self.assertRaises(ValueError):
+                call(function, True)
+            assert memoizer.get(lease_key) is memoizer.default_cache_value
+
+            # Another process holds the lease until it expires.
+            lease_key = function.make_cache_key(function.uncached,
+                                                False) + ':lease'
+            memoizer.add(lease_key, 1, timeout=60)
+            result = call(function, False)
+            assert call(function, False) == result
+            assert memoizer.get(lease_key) == 1
+
+    def test_93_write_behind_flushed_at_exit(self):
+        from memoize import _flush_write_behind_queues
+
+        with patch('memoize._write_behind_queues', weakref.WeakSet()):
+            write_behind = WriteBehind(block_timeout=2)
+            with patch.object(write_behind, 'flush') as flush:
+                _flush_write_behind_queues()
+            flush.assert_called_once_with(2)
+
+            # Queues are not kept alive for the exit flush.
+            ref = weakref.ref(write_behind)
+            del write_behind, flush
+            gc.collect()
+            assert ref() is None